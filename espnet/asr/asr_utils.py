@@ -9,6 +9,7 @@ import json
 import logging
 # matplotlib related
 import os
+import pickle
 import shutil
 import tempfile
 
@@ -27,6 +28,8 @@ import numpy as np
 import torch
 matplotlib.use('Agg')
 
+is_torch_2_1_plus = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
+
 
 # * -------------------- training iterator related -------------------- *
 
@@ -498,6 +501,34 @@ def snapshot_object(target, filename):
     return snapshot_object
 
 
+def torch_load_state_dict(path):
+    """Load torch model states without instantiating the model.
+
+    With PyTorch 2.1+ the file is memory-mapped and loaded with weights_only,
+    falling back to a full load for checkpoints holding Python objects.
+
+    Args:
+        path (str): Model path or snapshot file path to be loaded.
+
+    Returns:
+        OrderedDict: Model state_dict.
+
+    """
+    if is_torch_2_1_plus:
+        try:
+            model_state_dict = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        except (pickle.UnpicklingError, RuntimeError):
+            # e.g. trainer snapshots or checkpoints in the legacy (non-zip) format
+            model_state_dict = torch.load(path, map_location=lambda storage, loc: storage)
+    else:
+        model_state_dict = torch.load(path, map_location=lambda storage, loc: storage)
+
+    if 'snapshot' in os.path.basename(path):
+        model_state_dict = model_state_dict['model']
+
+    return model_state_dict
+
+
 def torch_load(path, model):
     """Load torch model states.
 
@@ -506,10 +537,7 @@ def torch_load(path, model):
         model (torch.nn.Module): Torch model.
 
     """
-    if 'snapshot' in os.path.basename(path):
-        model_state_dict = torch.load(path, map_location=lambda storage, loc: storage)['model']
-    else:
-        model_state_dict = torch.load(path, map_location=lambda storage, loc: storage)
+    model_state_dict = torch_load_state_dict(path)
 
     if hasattr(model, 'module'):
         model.module.load_state_dict(model_state_dict)
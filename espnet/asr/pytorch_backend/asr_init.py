@@ -1,13 +1,17 @@
 """Finetuning methods."""
 
+import argparse
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import gc
 import logging
 import os
+import re
 import torch
 
-from collections import OrderedDict
-
 from espnet.asr.asr_utils import get_model_conf
 from espnet.asr.asr_utils import torch_load
+from espnet.asr.asr_utils import torch_load_state_dict
 
 from espnet.nets.asr_interface import ASRInterface
 from espnet.nets.mt_interface import MTInterface
@@ -15,111 +19,134 @@ from espnet.nets.tts_interface import TTSInterface
 
 from espnet.utils.dynamic_import import dynamic_import
 
+# state_dicts loaded by get_trained_model_state_dict, keyed by (realpath, mtime)
+_STATE_DICT_CACHE = {}
+
+# model.json contents parsed by _get_model_conf, keyed by (realpath, mtime)
+_CONF_CACHE = {}
+
+# submodules of the ASR decoder renamed with an '_asr' suffix in dual decoders
+_DUAL_SUBMODULES = ('embed', 'after_norm', 'output_layer', 'self_attn', 'src_attn',
+                    'feed_forward', 'norm1', 'norm2', 'norm3', 'dropout')
+_DUAL_SUBMODULE_RE = re.compile('(' + '|'.join(map(re.escape, _DUAL_SUBMODULES)) + ')')
+
+# torch.inference_mode is available from PyTorch 1.9
+_inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
 
-def transfer_verification(model_state_dict, partial_state_dict, modules):
-    """Verify tuples (key, shape) for input model modules match specified modules.
+
+def _param_checksum(model):
+    """Sum all model parameters with a single device synchronization.
 
     Args:
-        model_state_dict (OrderedDict): the initial model state_dict
-        partial_state_dict (OrderedDict): the trained model state_dict
-        modules (list): specified module list for transfer
+        model (torch.nn.Module): model to summarize
 
     Return:
-        (boolean): allow transfer
+        (float): sum of all parameter values
 
     """
-    partial_modules = []
-    for key_p, value_p in partial_state_dict.items():
-        if any(key_p.startswith(m) for m in modules):
-            if value_p.shape == model_state_dict[key_p].shape:
-                partial_modules += [(key_p, value_p.shape)]
-    return len(partial_modules) > 0
+    with torch.no_grad():
+        return torch.stack([p.detach().float().sum() for p in model.parameters()]).sum().item()
+
 
+def _shape_matches(main_state_dict, key, value):
+    """Check whether value can be loaded into main_state_dict[key].
 
-def get_partial_state_dict(model_state_dict, modules):
-    """Create state_dict with specified modules matching input model modules.
+    Args:
+        main_state_dict (OrderedDict): the initial model state_dict or None
+        key (str): state_dict key in the initial model
+        value (torch.Tensor): trained tensor
+
+    Return:
+        (boolean): True if main_state_dict is None or the shapes match
 
-    Note that get_partial_lm_state_dict is used if a LM specified.
+    """
+    if main_state_dict is None:
+        return True
+    if key not in main_state_dict:
+        logging.warning('skip %s %s: not in the initial model', key, tuple(value.shape))
+        return False
+    if main_state_dict[key].shape != value.shape:
+        logging.warning('skip %s: shape %s in the trained model, %s in the initial model',
+                        key, tuple(value.shape), tuple(main_state_dict[key].shape))
+        return False
+    return True
+
+
+def get_partial_state_dict(model_state_dict, modules, main_state_dict=None):
+    """Select state_dict entries with specified modules matching input model modules.
 
     Args:
         model_state_dict (OrderedDict): trained model state_dict
         modules (list): specified module list for transfer
+        main_state_dict (OrderedDict): if given, only entries whose shape matches
+            this initial model state_dict are selected
 
-    Return:
-        new_state_dict (OrderedDict): the updated state_dict
+    Yields:
+        (str, torch.Tensor): key and value of each selected entry
 
     """
-    new_state_dict = OrderedDict()
+    prefixes = tuple(modules)
 
     for key, value in model_state_dict.items():
-        if any(key.startswith(m) for m in modules):
-            new_state_dict[key] = value
+        if key.startswith(prefixes) and _shape_matches(main_state_dict, key, value):
+            yield key, value
 
-    return new_state_dict
 
-
-def get_partial_state_dict_dual_decoders(model_state_dict, modules):
-    """Create state_dict with specified modules matching input model modules.
-
-    Note that get_partial_lm_state_dict is used if a LM specified.
+def get_partial_state_dict_dual_decoders(model_state_dict, modules, main_state_dict=None):
+    """Select state_dict entries with specified modules and rename them for dual decoders.
 
     Args:
         model_state_dict (OrderedDict): trained model state_dict
         modules (list): specified module list for transfer
+        main_state_dict (OrderedDict): if given, only entries whose shape matches
+            this initial model state_dict are selected
 
-    Return:
-        new_state_dict (OrderedDict): the updated state_dict
+    Yields:
+        (str, torch.Tensor): dual decoder key and value of each selected entry
 
     """
-    new_state_dict = OrderedDict()
-    new_modules = []
-    pretrained_keys = list(model_state_dict.keys())
-    submodules = ['embed', 'after_norm', 'output_layer', 'self_attn', 'src_attn', 
-                'feed_forward', 'norm1', 'norm2', 'norm3', 'dropout']
+    prefixes = tuple(modules)
 
     for key, value in model_state_dict.items():
-        if any(key.startswith(m) for m in modules):
+        if key.startswith(prefixes):
             key = key.replace('decoders', 'dual_decoders')
             if '_asr' not in key:
                 new_mod = key.replace('decoder.', 'dual_decoder.')
             else:
-                new_mod = key.replace('decoder_asr.', 'dual_decoder.')
-                for k in submodules:
-                    new_mod = new_mod.replace(k, k+'_asr')
-            new_state_dict[new_mod] = value
-            new_modules += [new_mod]
+                new_mod = _DUAL_SUBMODULE_RE.sub(r'\1_asr', key.replace('decoder_asr.', 'dual_decoder.'))
+            if _shape_matches(main_state_dict, new_mod, value):
+                yield new_mod, value
 
-    return new_state_dict, new_modules
 
+def _record_keys(partial_items, loaded_keys):
+    """Pass (key, value) pairs through while recording their keys.
 
-def get_partial_lm_state_dict(model_state_dict, modules):
-    """Create compatible ASR state_dict from model_state_dict (LM).
+    Args:
+        partial_items (iterable): (key, value) pairs selected from the trained model
+        loaded_keys (list): collects the keys of the passed pairs
+
+    Yields:
+        (str, torch.Tensor): the input pairs, unchanged
+
+    """
+    for key, value in partial_items:
+        loaded_keys.append(key)
+        yield key, value
 
-    The keys for specified modules are modified to match ASR decoder modules keys.
+
+def _has_prefix(sorted_keys, prefix):
+    """Check whether any key in a sorted key list starts with prefix.
 
     Args:
-        model_state_dict (OrderedDict): trained model state_dict
-        modules (list): specified module list for transfer
+        sorted_keys (list): lexicographically sorted state_dict keys
+        prefix (str): module prefix to look up
 
     Return:
-        new_state_dict (OrderedDict): the updated state_dict
-        new_mods (list): the updated module list
+        (boolean): True if at least one key starts with prefix
 
     """
-    new_state_dict = OrderedDict()
-    new_modules = []
-
-    for key, value in list(model_state_dict.items()):
-        if key == "predictor.embed.weight" and "predictor.embed." in modules:
-            new_key = "dec.embed.weight"
-            new_state_dict[new_key] = value
-            new_modules += [new_key]
-        elif "predictor.rnn." in key and "predictor.rnn." in modules:
-            new_key = "dec.decoder." + key.split("predictor.rnn.", 1)[1]
-            new_state_dict[new_key] = value
-            new_modules += [new_key]
-
-    return new_state_dict, new_modules
+    idx = bisect.bisect_left(sorted_keys, prefix)
+    return idx < len(sorted_keys) and sorted_keys[idx].startswith(prefix)
 
 
 def filter_modules(model_state_dict, modules):
@@ -135,10 +162,13 @@ def filter_modules(model_state_dict, modules):
     """
     new_mods = []
     incorrect_mods = []
+    if not modules:
+        return new_mods
 
     mods_model = list(model_state_dict.keys())
+    sorted_mods_model = sorted(mods_model)
     for mod in modules:
-        if any(key.startswith(mod) for key in mods_model):
+        if _has_prefix(sorted_mods_model, mod):
             new_mods += [mod]
         else:
             incorrect_mods += [mod]
@@ -165,9 +195,11 @@ def filter_modules_dual_decoders(model_state_dict, modules):
     """
     new_mods = []
     incorrect_mods = []
+    if not modules:
+        return new_mods
 
     mods_model = list(model_state_dict.keys())
-    new_mods = []
+    sorted_mods_model = sorted(mods_model)
 
     # Create tuple of (k_pretrained, k_new)
     for new_mod in modules:
@@ -177,7 +209,7 @@ def filter_modules_dual_decoders(model_state_dict, modules):
         else:
             mod = new_mod.replace('_asr', '').replace('dual_decoder.', 'decoder_asr.')
 
-        if any(key.startswith(mod) for key in mods_model):
+        if _has_prefix(sorted_mods_model, mod):
             new_mods += [mod]
         else:
             incorrect_mods += [mod]
@@ -191,6 +223,25 @@ def filter_modules_dual_decoders(model_state_dict, modules):
     return new_mods
 
 
+def _get_model_conf(model_path, conf_path):
+    """Get model config information, parsing each model.json only once.
+
+    Args:
+        model_path (str): Model path.
+        conf_path (str): Model config path.
+
+    Return:
+        idim (int), odim (int), args (Namespace): a copy of the config information
+
+    """
+    cache_key = (os.path.realpath(conf_path), os.path.getmtime(conf_path))
+    if cache_key not in _CONF_CACHE:
+        _CONF_CACHE[cache_key] = get_model_conf(model_path, conf_path)
+    idim, odim, args = _CONF_CACHE[cache_key]
+    # callers may modify the returned Namespace
+    return idim, odim, argparse.Namespace(**vars(args))
+
+
 def load_trained_model(model_path):
     """Load the trained model for recognition.
 
@@ -198,7 +249,7 @@ def load_trained_model(model_path):
         model_path (str): Path to model.***.best
 
     """
-    idim, odim, train_args = get_model_conf(
+    idim, odim, train_args = _get_model_conf(
         model_path, os.path.join(os.path.dirname(model_path), 'model.json'))
 
     logging.warning('reading model parameters from ' + model_path)
@@ -215,27 +266,46 @@ def load_trained_model(model_path):
     return model, train_args
 
 
-def get_trained_model_state_dict(model_path):
+@_inference_mode()
+def get_trained_model_state_dict(model_path, validate=False):
     """Extract the trained model state dict for pre-initialization.
 
     Args:
         model_path (str): Path to model.***.best
+        validate (bool): Build the model from model.json and check its interface
+            instead of reading the state_dict directly from the checkpoint
 
     Return:
         model.state_dict() (OrderedDict): the loaded model state_dict
         (bool): Boolean defining whether the model is an LM
 
     """
-    conf_path = os.path.join(os.path.dirname(model_path), 'model.json')
+    cache_key = (os.path.realpath(model_path), os.path.getmtime(model_path))
+    if cache_key in _STATE_DICT_CACHE:
+        logging.warning('reusing model parameters from %s', model_path)
+        return _STATE_DICT_CACHE[cache_key]
+
     if 'rnnlm' in model_path:
         logging.warning('reading model parameters from %s', model_path)
 
-        return torch.load(model_path), True
-
-    idim, odim, args = get_model_conf(model_path, conf_path)
+        _STATE_DICT_CACHE[cache_key] = torch_load_state_dict(model_path), True
+        return _STATE_DICT_CACHE[cache_key]
 
     logging.warning('reading model parameters from ' + model_path)
 
+    if not validate:
+        state_dict = torch_load_state_dict(model_path)
+        # unwrap checkpoints saved as {'model': state_dict, ...}
+        for key in ('model', 'state_dict'):
+            if isinstance(state_dict.get(key, None), dict):
+                state_dict = state_dict[key]
+                break
+        _STATE_DICT_CACHE[cache_key] = state_dict, False
+        return _STATE_DICT_CACHE[cache_key]
+
+    conf_path = os.path.join(os.path.dirname(model_path), 'model.json')
+    idim, odim, args = _get_model_conf(model_path, conf_path)
+
     if hasattr(args, "model_module"):
         model_module = args.model_module
     else:
@@ -251,7 +321,11 @@ def get_trained_model_state_dict(model_path):
         isinstance(model, ASRInterface) or \
         isinstance(model, TTSInterface)
 
-    return model.state_dict(), False
+    _STATE_DICT_CACHE[cache_key] = model.state_dict(), False
+    del model
+    gc.collect()
+
+    return _STATE_DICT_CACHE[cache_key]
 
 
 def load_trained_modules(idim, odim, args, interface=ASRInterface):
@@ -267,65 +341,95 @@ def load_trained_modules(idim, odim, args, interface=ASRInterface):
         model (torch.nn.Module): The model with pretrained modules.
 
     """
-    enc_model_path = args.enc_init
-    dec_model_path = args.dec_init
-    enc_modules = args.enc_init_mods
-    dec_modules = args.dec_init_mods
-    dual_modules = None
+    updated = False
 
     model_class = dynamic_import(args.model_module)
     main_model = model_class(idim, odim, args)
     assert isinstance(main_model, interface)
-    logging.info('| Before loading pretrained models: {}'.format(sum(p.sum().item() for p in main_model.parameters())))
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info('| Before loading pretrained models: {}'.format(_param_checksum(main_model)))
 
     main_state_dict = main_model.state_dict()
 
-    logging.warning('model(s) found for pre-initialization')
-    for model_path, modules in [(enc_model_path, enc_modules),
-                                (dec_model_path, dec_modules)]:
-        if model_path is not None:
-            if os.path.isfile(model_path):
-                model_state_dict, is_lm = get_trained_model_state_dict(model_path)
-
-                if all(mod.startswith('dual_decoder') for mod in modules):
-                    dual_modules = modules
-                    modules = filter_modules_dual_decoders(model_state_dict, modules)
-                else:
-                    modules = filter_modules(model_state_dict, modules)
-
-                if is_lm:
-                    partial_state_dict, modules = get_partial_lm_state_dict(model_state_dict, modules)
-                else:
-                    if dual_modules is not None:
-                        partial_state_dict, modules = get_partial_state_dict_dual_decoders(model_state_dict, modules)
-                    else:
-                        partial_state_dict = get_partial_state_dict(model_state_dict, modules)
-
-                    if partial_state_dict:
-                        if transfer_verification(main_state_dict, partial_state_dict, modules):
-                            logging.warning('loading %s from model: %s', list(set(['.'.join(m.split('.')[:2]) for m in modules])), model_path)
-                            
-                            for k in partial_state_dict.keys():
-                                logging.warning('override %s' % k)
-                            main_state_dict.update(partial_state_dict)
-                        else:
-                            logging.warning('modules %s in model %s don\'t match your training config',
-                                            modules, model_path)
-                        # Random check
-                        k1 = 'decoder.decoders.0.src_attn.linear_v.weight'
-                        k2 = 'decoder_asr.decoders.0.src_attn.linear_v.weight'
-                        if k1 in partial_state_dict and k2 in partial_state_dict:
-                            a = partial_state_dict[k1]
-                            b = partial_state_dict[k2]
-                            logging.info('TO'*20)
-                            logging.info(f'diff = {torch.norm(a - b)}')
-                            logging.info(f'a is b = {a is b}')
-                    
-            else:
+    # cached checkpoints are only needed while loading, drop them even if loading fails
+    try:
+        logging.warning('model(s) found for pre-initialization')
+        # resolve once per checkpoint how its modules are transferred: 'lm', 'dual' or 'plain'
+        jobs = []
+        for model_path, modules in [(args.enc_init, args.enc_init_mods),
+                                    (args.dec_init, args.dec_init_mods)]:
+            if model_path is None:
+                continue
+            if not os.path.isfile(model_path):
                 logging.warning('model was not found : %s', model_path)
-
-    main_model.load_state_dict(main_state_dict)
-
-    logging.info('| After loading pretrained models: {}'.format(sum(p.sum().item() for p in main_model.parameters())))
+                continue
+            if 'rnnlm' in model_path:
+                mode = 'lm'
+            elif all(mod.startswith('dual_decoder') for mod in modules):
+                mode = 'dual'
+            else:
+                mode = 'plain'
+            jobs.append((model_path, modules, mode))
+
+        # read distinct checkpoints concurrently; the loop below picks them up from the cache
+        # (one of the paths as given per file, get_trained_model_state_dict checks the name for 'rnnlm')
+        init_paths = {}
+        for model_path, _, _ in jobs:
+            init_paths.setdefault(os.path.realpath(model_path), model_path)
+        if len(init_paths) > 1:
+            with ThreadPoolExecutor(max_workers=len(init_paths)) as executor:
+                list(executor.map(get_trained_model_state_dict, init_paths.values()))
+
+        for model_path, modules, mode in jobs:
+            model_state_dict, _ = get_trained_model_state_dict(model_path)
+
+            if mode == 'dual':
+                filtered_modules = filter_modules_dual_decoders(model_state_dict, modules)
+                partial_items = get_partial_state_dict_dual_decoders(model_state_dict, filtered_modules,
+                                                                     main_state_dict)
+            else:
+                filtered_modules = filter_modules(model_state_dict, modules)
+                if mode == 'lm':
+                    # LM modules are only filtered here, they are not transferred
+                    continue
+                partial_items = get_partial_state_dict(model_state_dict, filtered_modules, main_state_dict)
+
+            # stream the selected (shape-checked) tensors straight into the initial state_dict
+            loaded_keys = []
+            main_state_dict.update(_record_keys(partial_items, loaded_keys))
+            if loaded_keys:
+                updated = True
+                # dual decoder modules are renamed, so report the keys actually loaded
+                loaded_modules = loaded_keys if mode == 'dual' else filtered_modules
+                top_modules = {'.'.join(m.split('.', 2)[:2]) for m in loaded_modules}
+                logging.warning('loading %s from model: %s', list(top_modules), model_path)
+                if logging.getLogger().isEnabledFor(logging.WARNING):
+                    logging.warning('override %d keys:\n  %s', len(loaded_keys), '\n  '.join(loaded_keys))
+            else:
+                logging.warning('modules %s in model %s don\'t match your training config',
+                                filtered_modules, model_path)
+            # Random check (debug only, set ESPNET_DUMP_INIT_DIFF to enable)
+            k1 = 'decoder.decoders.0.src_attn.linear_v.weight'
+            k2 = 'decoder_asr.decoders.0.src_attn.linear_v.weight'
+            if logging.getLogger().isEnabledFor(logging.DEBUG) and os.environ.get('ESPNET_DUMP_INIT_DIFF') \
+                    and k1 in loaded_keys and k2 in loaded_keys:
+                a = main_state_dict[k1]
+                b = main_state_dict[k2]
+                logging.debug('TO'*20)
+                if a is b or torch.equal(a, b):
+                    logging.debug('diff = 0.0')
+                else:
+                    logging.debug(f'diff = {torch.norm(a - b)}')
+                logging.debug(f'a is b = {a is b}')
+
+        # main_state_dict still references the model's own tensors if nothing was transferred
+        if updated:
+            with torch.no_grad():
+                main_model.load_state_dict(main_state_dict)
+    finally:
+        _STATE_DICT_CACHE.clear()
+
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info('| After loading pretrained models: {}'.format(_param_checksum(main_model)))
 
     return main_model
@@ -102,6 +102,16 @@ def get_parser():
                         help='Input length ratio to obtain min output length')
     parser.add_argument('--ratio-diverse-asr', type=float, default=0.0,
                         help='Input length ratio to obtain min output length')
+    parser.add_argument('--autocast-dtype', type=str, default='none',
+                        choices=['none', 'bfloat16', 'float16'],
+                        help='Decode under autocast with this dtype on GPU (bfloat16 only on CPU), '
+                             'none keeps the --transformer-autocast-dtype of the model.')
+    parser.add_argument('--dual-stream', default=False, type=strtobool,
+                        help='Run the ASR branch of the dual decoder on a second CUDA stream, '
+                             'concurrently with the ST branch.')
+    parser.add_argument('--simple-beam-stop', default=False, type=strtobool,
+                        help='Stop beam search once at least beam-size hypotheses have ended '
+                             '(can change the results compared with end detection).')
     parser.add_argument('--wait-k-asr', type=int, default=0,
                         help='ASR waits ST for k steps.')
     parser.add_argument('--wait-k-st', type=int, default=0,
@@ -9,8 +9,11 @@
 from argparse import Namespace
 from distutils.util import strtobool
 
+import contextlib
+import heapq
 import logging
 import math
+import numpy as np
 import six
 
 import torch
@@ -22,9 +25,6 @@ from espnet.nets.pytorch_backend.ctc import CTC
 from espnet.nets.pytorch_backend.e2e_asr import CTC_LOSS_THRESHOLD
 from espnet.nets.pytorch_backend.e2e_st import Reporter
 from espnet.nets.pytorch_backend.nets_utils import get_subsample
-from espnet.nets.pytorch_backend.nets_utils import make_pad_mask
-from espnet.nets.pytorch_backend.nets_utils import pad_list
-from espnet.nets.pytorch_backend.nets_utils import th_accuracy
 from espnet.nets.pytorch_backend.transformer.add_sos_eos import add_sos_eos
 from espnet.nets.pytorch_backend.transformer.attention import MultiHeadedAttention
 from espnet.nets.pytorch_backend.transformer.decoder_dual import DualDecoder
@@ -80,6 +80,26 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
                            help='optimizer warmup steps')
         group.add_argument('--transformer-length-normalized-loss', default=True, type=strtobool,
                            help='normalize loss by length')
+        group.add_argument('--transformer-use-sdpa', default=True, type=strtobool,
+                           help='use fused scaled_dot_product_attention kernels in the dual decoder '
+                                '(requires PyTorch 2.0+)')
+        group.add_argument('--transformer-autocast-dtype', default='none', type=str,
+                           choices=['none', 'bfloat16', 'float16'],
+                           help='run the encoders and the dual decoder under torch.autocast with this dtype '
+                                '(requires PyTorch 1.10+); CTC and the loss reduction stay in float32')
+        group.add_argument('--transformer-allow-tf32', default=False, type=strtobool,
+                           help='let float32 matmuls and convolutions use TF32 tensor cores on GPU '
+                                '(changes the matmul precision of the whole process)')
+        group.add_argument('--transformer-use-compile', default=False, type=strtobool,
+                           help='compile the encoders and the dual decoder with torch.compile on GPU '
+                                '(requires PyTorch 2.2+, single GPU only)')
+        group.add_argument('--transformer-fused-add-norm', default=False, type=strtobool,
+                           help='fuse the residual adds of the dual decoder with the following layer '
+                                'normalization into compiled kernels on GPU (requires PyTorch 2.0+)')
+        group.add_argument('--transformer-tie-embeddings', default=False, type=strtobool,
+                           help='share the weights of the dual decoder output layers with their input embeddings')
+        group.add_argument('--transformer-share-asr-embeddings', default=False, type=strtobool,
+                           help='share the ASR embeddings of the dual decoder with the ST embeddings')
 
         group.add_argument('--dropout-rate', default=0.0, type=float,
                            help='Dropout rate for the encoder')
@@ -212,9 +232,24 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
                 cross_self=self.cross_self,
                 cross_src=self.cross_src,
                 cross_to_asr=self.cross_to_asr,
-                cross_to_st=self.cross_to_st
+                cross_to_st=self.cross_to_st,
+                use_sdpa=getattr(args, "transformer_use_sdpa", True),
+                fused_add_norm=getattr(args, "transformer_fused_add_norm", False),
+                tie_embeddings=getattr(args, "transformer_tie_embeddings", False),
+                share_asr_embeddings=getattr(args, "transformer_share_asr_embeddings", False)
         )
 
+        autocast_dtype = getattr(args, "transformer_autocast_dtype", "none")
+        self.autocast_dtype = None if autocast_dtype == "none" else getattr(torch, autocast_dtype)
+        if getattr(args, "transformer_allow_tf32", False) and torch.cuda.is_available():
+            # process-wide setting, only changed when explicitly requested
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        self.use_compile = getattr(args, "transformer_use_compile", False)
+        self._compiled = False
+        self._traced_dual_step = None
+        self._step_masks = None
+
         self.pad = 0
         self.sos = odim - 1
         self.eos = odim - 1
@@ -292,6 +327,8 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
         :return: accuracy in attention decoder
         :rtype: float
         """
+        self._compile_modules(xs_pad.device)
+
         # 0. Extract target language ID
         # src_lang_ids = None
         tgt_lang_ids, tgt_lang_ids_src = None, None
@@ -307,103 +344,97 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
                 tgt_lang_ids_src = ys_pad_src[:, 0:1]
                 ys_pad_src = ys_pad_src[:, 1:]  # remove target language ID in the beggining
 
-        # 1. forward encoder
-        xs_pad = xs_pad[:, :max(ilens)]  # for data parallel # bs x max_ilens x idim
+        with self._autocast(xs_pad.device):
+            # 1. forward encoder
+            xs_pad = xs_pad[:, :int(ilens.max())]  # for data parallel # bs x max_ilens x idim
 
-        if self.lang_tok == "encoder-pre-sum":
-            lang_embed = self.language_embeddings(tgt_lang_ids) # bs x 1 x idim
-            xs_pad = xs_pad + lang_embed
+            if self.lang_tok == "encoder-pre-sum":
+                lang_embed = self.language_embeddings(tgt_lang_ids) # bs x 1 x idim
+            else:
+                lang_embed = None
 
-        src_mask = (~make_pad_mask(ilens.tolist())).to(xs_pad.device).unsqueeze(-2) # bs x 1 x max_ilens
-        hs_pad, hs_mask = self.encoder(xs_pad, src_mask) # hs_pad: bs x (max_ilens/4) x adim; hs_mask: bs x 1 x (max_ilens/4)
-        self.hs_pad = hs_pad
+            # built on the device of ilens, without a round trip through a python list
+            src_mask = (torch.arange(xs_pad.size(1), device=ilens.device).unsqueeze(0)
+                        < ilens.unsqueeze(1)).to(xs_pad.device).unsqueeze(-2) # bs x 1 x max_ilens
+            hs_pad, hs_mask = self.encoder(xs_pad, src_mask, lang_embed) # hs_pad: bs x (max_ilens/4) x adim; hs_mask: bs x 1 x (max_ilens/4)
+
+        with self._autocast(xs_pad.device):
+            # 2. forward decoder
+            ys_in_pad, ys_out_pad = add_sos_eos(ys_pad, self.sos, self.eos, self.ignore_id) # bs x max_lens
+
+            if self.do_asr:
+                ys_in_pad_src, ys_out_pad_src = add_sos_eos(ys_pad_src, self.sos, self.eos, self.ignore_id) # bs x max_lens_src
 
-        # 2. forward decoder
-        ys_in_pad, ys_out_pad = add_sos_eos(ys_pad, self.sos, self.eos, self.ignore_id) # bs x max_lens
+            # replace <sos> with target language ID
+            if self.replace_sos:
+                ys_in_pad = torch.cat([tgt_lang_ids, ys_in_pad[:, 1:]], dim=1)
 
-        if self.do_asr:
-            ys_in_pad_src, ys_out_pad_src = add_sos_eos(ys_pad_src, self.sos, self.eos, self.ignore_id) # bs x max_lens_src
+            if self.lang_tok == "decoder-pre":
+                ys_in_pad = torch.cat([tgt_lang_ids, ys_in_pad[:, 1:]], dim=1)
+                if self.do_asr:
+                    ys_in_pad_src = torch.cat([tgt_lang_ids_src, ys_in_pad_src[:, 1:]], dim=1)
 
-        # replace <sos> with target language ID
-        if self.replace_sos:
-            ys_in_pad = torch.cat([tgt_lang_ids, ys_in_pad[:, 1:]], dim=1)
+            ys_mask = target_mask(ys_in_pad, self.ignore_id) # bs x max_lens x max_lens
 
-        if self.lang_tok == "decoder-pre":
-            ys_in_pad = torch.cat([tgt_lang_ids, ys_in_pad[:, 1:]], dim=1)
             if self.do_asr:
-                ys_in_pad_src = torch.cat([tgt_lang_ids_src, ys_in_pad_src[:, 1:]], dim=1)
+                ys_mask_src = target_mask(ys_in_pad_src, self.ignore_id) # bs x max_lens x max_lens_src
+
+            if self.wait_k_asr > 0:
+                cross_mask = create_cross_mask(ys_in_pad, ys_in_pad_src, self.ignore_id, wait_k_cross=self.wait_k_asr)
+                cross_mask_asr = create_cross_mask(ys_in_pad_src, ys_in_pad, self.ignore_id, wait_k_cross=-self.wait_k_asr)
+            elif self.wait_k_st > 0:
+                cross_mask = create_cross_mask(ys_in_pad, ys_in_pad_src, self.ignore_id, wait_k_cross=-self.wait_k_st)
+                cross_mask_asr = create_cross_mask(ys_in_pad_src, ys_in_pad, self.ignore_id, wait_k_cross=self.wait_k_st)
+            else:
+                cross_mask = create_cross_mask(ys_in_pad, ys_in_pad_src, self.ignore_id, wait_k_cross=0)
+                cross_mask_asr = create_cross_mask(ys_in_pad_src, ys_in_pad, self.ignore_id, wait_k_cross=0)
 
-        ys_mask = target_mask(ys_in_pad, self.ignore_id) # bs x max_lens x max_lens
+            pred_pad, pred_mask, pred_pad_asr, pred_mask_asr = self.dual_decoder(ys_in_pad, ys_mask, ys_in_pad_src, ys_mask_src,
+                                                                                    hs_pad, hs_mask, cross_mask, cross_mask_asr,
+                                                                                    cross_self=self.cross_self, cross_src=self.cross_src,
+                                                                                    cross_self_from=self.cross_self_from,
+                                                                                    cross_src_from=self.cross_src_from)
 
-        if self.do_asr:
-            ys_mask_src = target_mask(ys_in_pad_src, self.ignore_id) # bs x max_lens x max_lens_src
+            pred_pad_mt = None
 
-        if self.wait_k_asr > 0:
-            cross_mask = create_cross_mask(ys_in_pad, ys_in_pad_src, self.ignore_id, wait_k_cross=self.wait_k_asr)
-            cross_mask_asr = create_cross_mask(ys_in_pad_src, ys_in_pad, self.ignore_id, wait_k_cross=-self.wait_k_asr)
-        elif self.wait_k_st > 0:
-            cross_mask = create_cross_mask(ys_in_pad, ys_in_pad_src, self.ignore_id, wait_k_cross=-self.wait_k_st)
-            cross_mask_asr = create_cross_mask(ys_in_pad_src, ys_in_pad, self.ignore_id, wait_k_cross=self.wait_k_st)
-        else:
-            cross_mask = create_cross_mask(ys_in_pad, ys_in_pad_src, self.ignore_id, wait_k_cross=0)
-            cross_mask_asr = create_cross_mask(ys_in_pad_src, ys_in_pad, self.ignore_id, wait_k_cross=0)
-
-        pred_pad, pred_mask, pred_pad_asr, pred_mask_asr = self.dual_decoder(ys_in_pad, ys_mask, ys_in_pad_src, ys_mask_src,
-                                                                                hs_pad, hs_mask, cross_mask, cross_mask_asr,
-                                                                                cross_self=self.cross_self, cross_src=self.cross_src,
-                                                                                cross_self_from=self.cross_self_from,
-                                                                                cross_src_from=self.cross_src_from)
-
-        self.pred_pad = pred_pad
-        self.pred_pad_asr = pred_pad_asr
-        pred_pad_mt = None
-
-        # 3. compute attention loss
-        loss_asr, loss_mt = 0.0, 0.0
-        loss_att = self.criterion(pred_pad, ys_out_pad)
-
-        # compute loss
-        loss_asr = self.criterion(pred_pad_asr, ys_out_pad_src)
-        # Multi-task w/ MT
-        if self.mt_weight > 0:
-            # forward MT encoder
-            ilens_mt = torch.sum(ys_pad_src != self.ignore_id, dim=1).cpu().numpy()
-            # NOTE: ys_pad_src is padded with -1
-            ys_src = [y[y != self.ignore_id] for y in ys_pad_src]  # parse padded ys_src
-            ys_zero_pad_src = pad_list(ys_src, self.pad)  # re-pad with zero
-            ys_zero_pad_src = ys_zero_pad_src[:, :max(ilens_mt)]  # for data parallel
-            src_mask_mt = (~make_pad_mask(ilens_mt.tolist())).to(ys_zero_pad_src.device).unsqueeze(-2)
-            # ys_zero_pad_src, ys_pad = self.target_forcing(ys_zero_pad_src, ys_pad)
-            hs_pad_mt, hs_mask_mt = self.encoder_mt(ys_zero_pad_src, src_mask_mt)
-            # forward MT decoder
-            pred_pad_mt, _ = self.decoder(ys_in_pad, ys_mask, hs_pad_mt, hs_mask_mt)
-            # compute loss
-            loss_mt = self.criterion(pred_pad_mt, ys_out_pad)
+            # 3. compute attention loss
+            loss_asr, loss_mt = 0.0, 0.0
+            loss_att = self.criterion(pred_pad, ys_out_pad)
+            acc_stats = [self.criterion.acc_stats]
 
-        self.acc = th_accuracy(pred_pad.view(-1, self.odim), ys_out_pad,
-                               ignore_label=self.ignore_id)
-        if pred_pad_asr is not None:
-            self.acc_asr = th_accuracy(pred_pad_asr.view(-1, self.odim), ys_out_pad_src,
-                                       ignore_label=self.ignore_id)
-        else:
-            self.acc_asr = 0.0
-        if pred_pad_mt is not None:
-            self.acc_mt = th_accuracy(pred_pad_mt.view(-1, self.odim), ys_out_pad,
-                                      ignore_label=self.ignore_id)
-        else:
-            self.acc_mt = 0.0
+            # compute loss
+            loss_asr = self.criterion(pred_pad_asr, ys_out_pad_src)
+            acc_stats.append(self.criterion.acc_stats)
+            # Multi-task w/ MT
+            if self.mt_weight > 0:
+                # forward MT encoder
+                # NOTE: ys_pad_src is right-padded with -1, so re-padding with zero is a fill
+                src_mask_mt = ys_pad_src != self.ignore_id
+                ilens_mt = src_mask_mt.sum(dim=1)
+                max_ilen_mt = int(ilens_mt.max())  # for data parallel
+                ys_zero_pad_src = ys_pad_src.masked_fill(~src_mask_mt, self.pad)[:, :max_ilen_mt]
+                src_mask_mt = src_mask_mt[:, :max_ilen_mt].unsqueeze(-2)
+                # ys_zero_pad_src, ys_pad = self.target_forcing(ys_zero_pad_src, ys_pad)
+                hs_pad_mt, hs_mask_mt = self.encoder_mt(ys_zero_pad_src, src_mask_mt)
+                # forward MT decoder
+                pred_pad_mt, _ = self.decoder(ys_in_pad, ys_mask, hs_pad_mt, hs_mask_mt)
+                # compute loss
+                loss_mt = self.criterion(pred_pad_mt, ys_out_pad)
+                acc_stats.append(self.criterion.acc_stats)
 
         # TODO(karita) show predicted text
         # TODO(karita) calculate these stats
+        # 4. compute ctc loss (in float32)
         cer_ctc = None
         if self.mtlalpha == 0.0 or self.asr_weight == 0:
             loss_ctc = 0.0
         else:
             batch_size = xs_pad.size(0)
             hs_len = hs_mask.view(batch_size, -1).sum(1)
-            loss_ctc = self.ctc(hs_pad.view(batch_size, -1, self.adim), hs_len, ys_pad_src)
+            hs_flat = hs_pad.float().view(batch_size, -1, self.adim)
+            loss_ctc = self.ctc(hs_flat, hs_len, ys_pad_src)
             if self.error_calculator is not None:
-                ys_hat = self.ctc.argmax(hs_pad.view(batch_size, -1, self.adim)).data
+                ys_hat = self.ctc.argmax(hs_flat).data
                 cer_ctc = self.error_calculator(ys_hat.cpu(), ys_pad_src.cpu(), is_ctc=True)
 
         # 5. compute cer/wer
@@ -418,13 +449,22 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
         alpha = self.mtlalpha
         self.loss = (1 - self.asr_weight - self.mt_weight) * loss_att + self.asr_weight * \
             (alpha * loss_ctc + (1 - alpha) * loss_asr) + self.mt_weight * loss_mt
-        loss_asr_data = float(alpha * loss_ctc + (1 - alpha) * loss_asr)
-        loss_mt_data = None if self.mt_weight == 0 else float(loss_mt)
-        loss_st_data = float(loss_att)
+        # fetch all reported values, including the accuracy counts gathered by
+        # the criterion, with a single device-to-host copy
+        loss_values = [self.loss, alpha * loss_ctc + (1 - alpha) * loss_asr, loss_att]
+        if self.mt_weight > 0:
+            loss_values.append(loss_mt)
+        loss_values = torch.cat([torch.stack([v.detach().float() for v in loss_values])] +
+                                [a.float() for a in acc_stats]).tolist()
+        loss_data, loss_asr_data, loss_st_data = loss_values[:3]
+        loss_mt_data = loss_values[3] if self.mt_weight > 0 else None
+        acc_values = loss_values[-2 * len(acc_stats):]
+        accs = [correct / total for correct, total in zip(acc_values[::2], acc_values[1::2])]
+        self.acc, self.acc_asr = accs[:2]
+        self.acc_mt = accs[2] if self.mt_weight > 0 else 0.0
 
         # logging.info(f'loss_st_data={loss_st_data}')
 
-        loss_data = float(self.loss)
         if loss_data < CTC_LOSS_THRESHOLD and not math.isnan(loss_data):
             self.reporter.report(loss_asr_data, loss_mt_data, loss_st_data,
                                  self.acc_asr, self.acc_mt, self.acc,
@@ -434,6 +474,42 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
             logging.warning('loss (=%f) is not correct', loss_data)
         return self.loss
 
+    def _compile_modules(self, device):
+        """Compile the encoders and the dual decoder once when --transformer-use-compile is set.
+
+        The submodules are compiled in place with `torch.nn.Module.compile` (PyTorch 2.2+), so that
+        parameter names, snapshots and module replication stay unchanged. Compilation is skipped
+        on CPU, where it does not pay off.
+
+        :param torch.device device: device the model runs on
+        """
+        if not self.use_compile or self._compiled or device.type != "cuda":
+            return
+        self._compiled = True
+        if not hasattr(torch.nn.Module, "compile"):
+            logging.warning("--transformer-use-compile requires PyTorch 2.2+, running without compilation")
+            return
+        modules = [self.encoder, self.dual_decoder]
+        if self.mt_weight > 0:
+            modules.append(self.encoder_mt)
+        for m in modules:
+            m.compile(dynamic=True)
+
+    def _autocast(self, device, dtype=None):
+        """Return the autocast context selected by --transformer-autocast-dtype.
+
+        :param torch.device device: device the computation runs on
+        :param torch.dtype dtype: autocast dtype overriding the model setting
+        :return: autocast context, or a no-op context when autocast is disabled or unsupported
+        """
+        dtype = self.autocast_dtype if dtype is None else dtype
+        if dtype is None or not hasattr(torch, "autocast"):
+            return contextlib.nullcontext()
+        if device.type != "cuda" and dtype != torch.bfloat16:
+            # CPU autocast only supports bfloat16
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=device.type, dtype=dtype)
+
     def scorers(self):
         """Scorers."""
         return dict(decoder=self.decoder)
@@ -446,8 +522,10 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
         :rtype: torch.Tensor
         """
         self.eval()
-        x = torch.as_tensor(x).unsqueeze(0)
-        enc_output, _ = self.encoder(x, None)
+        x = torch.as_tensor(x, device=next(self.parameters()).device).unsqueeze(0)
+        self._compile_modules(x.device)
+        with self._autocast(x.device):
+            enc_output, _ = self.encoder(x, None)
         return enc_output.squeeze(0)
 
     def recognize_and_translate_sum(self, x, trans_args, 
@@ -492,12 +570,22 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
         logging.info(f'<sos> index: {str(y)}; <sos> mark: {char_list[y]}')
         logging.info(f'<sos> index asr: {str(y_asr)}; <sos> mark asr: {char_list[y_asr]}')
 
-        enc_output = self.encode(x).unsqueeze(0)
+        # decoding may run in reduced precision even if the model was trained in fp32,
+        # the output logits are cast to fp32 before the beam selection, so the beam scores keep full precision
+        autocast_dtype = getattr(trans_args, "autocast_dtype", "none")
+        autocast_dtype = None if autocast_dtype == "none" else getattr(torch, autocast_dtype)
+        with self._autocast(next(self.parameters()).device, autocast_dtype):
+            enc_output = self.encode(x).unsqueeze(0)
         h = enc_output.squeeze(0)
+        # the source attentions attend the same memory at every step, project it only once
+        with self._autocast(enc_output.device, autocast_dtype):
+            memory_kv = self.dual_decoder.precompute_memory_kv(enc_output)
         logging.info('input lengths: ' + str(h.size(0)))
 
         # search parms
         beam = trans_args.beam_size
+        simple_beam_stop = getattr(trans_args, "simple_beam_stop", False)
+        dual_stream = getattr(trans_args, "dual_stream", False)
         penalty = trans_args.penalty
 
         vy = h.new_zeros(1).long()
@@ -516,200 +604,210 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
         logging.info(f'max output length asr: {str(maxlen_asr)}; min output length asr: {str(minlen_asr)}')
 
         # initialize hypothesis
+        # prefixes are int64 arrays while searching, so that a group of them is stacked with one copy
         if rnnlm:
-            hyp = {'score': 0.0, 'yseq': [y], 'rnnlm_prev': None}
+            hyp = {'score': 0.0, 'yseq': np.array([y], dtype=np.int64), 'rnnlm_prev': None}
         else:
             logging.info('initializing hypothesis...')
-            hyp = {'score': 0.0, 'yseq': [y], 'yseq_asr': [y_asr]}
+            hyp = {'score': 0.0, 'yseq': np.array([y], dtype=np.int64), 'yseq_asr': np.array([y_asr], dtype=np.int64),
+                   'cache': None, 'cache_asr': None}
 
         hyps = [hyp]
         ended_hyps = []
+        ended_hyps_per_step = []
+        # the hypotheses are only spelled out for debug logs
+        log_hyps = char_list is not None and logging.getLogger().isEnabledFor(logging.DEBUG)
+        # cross attention at the source attention stage needs the hidden states of all
+        # positions of the other decoder, which the per-layer output cache does not keep;
+        # with wait-k the prefixes of the two decoders grow at different steps, so the cached
+        # outputs of cross attention at the self attention stage would go stale as well
+        use_cache = not self.cross_src and not (self.cross_self and (self.wait_k_asr or self.wait_k_st))
+
+        # the masks of every step are slices of these; hypotheses never contain ignore_id,
+        # so the cross masks reduce to the (wait-k shifted) triangles
+        device = enc_output.device
+        tril, cross_tril, cross_tril_asr = self._batch_step_masks(max(maxlen, maxlen_asr) + 2, device)
+
+        # rows (cr) and columns (ct) of the joint score grid kept by the diversity options
+        ct = int((1 - ratio_diverse_st) * beam) if ratio_diverse_st > 0 else beam
+        cr = int((1 - ratio_diverse_asr) * beam) if ratio_diverse_asr > 0 else beam
+        if ratio_diverse_st > 0 and ratio_diverse_asr > 0:
+            ct = max(ct, beam // cr)
 
-        traced_decoder = None
         for i in six.moves.range(max(maxlen, maxlen_asr)):
             logging.info('position ' + str(i))
 
+            # bounded min-heap of (score, -insertion order, hyp); on equal scores the
+            # earlier candidate is kept, as with the stable sort it replaces
             hyps_best_kept = []
-
+            n_kept = 0
+            heappush, heappushpop = heapq.heappush, heapq.heappushpop
+
+            ys_len = max(1, i + 1 - max(self.wait_k_asr, 0))
+            ys_mask = tril[:, :ys_len, :ys_len]
+            ys_len_asr = max(1, i + 1 - max(self.wait_k_st, 0))
+            ys_mask_asr = tril[:, :ys_len_asr, :ys_len_asr]
+
+            # run the decoder once for all hypotheses with the same prefix lengths,
+            # and only score the heads that have not ended (or are not waiting)
+            step_outputs = [None] * len(hyps)
+            groups = {}
             for idx, hyp in enumerate(hyps):
-                if self.wait_k_asr > 0:
-                    if i < self.wait_k_asr:
-                        ys_mask = subsequent_mask(1).unsqueeze(0)
-                    else:
-                        ys_mask = subsequent_mask(i - self.wait_k_asr + 1).unsqueeze(0)
-                else:
-                    ys_mask = subsequent_mask(i + 1).unsqueeze(0)
-                ys = torch.tensor(hyp['yseq']).unsqueeze(0)
-
-                if self.wait_k_st > 0:
-                    if i < self.wait_k_st:
-                        ys_mask_asr = subsequent_mask(1).unsqueeze(0)
-                    else:
-                        ys_mask_asr = subsequent_mask(i - self.wait_k_st + 1).unsqueeze(0)
-                else:
-                    ys_mask_asr = subsequent_mask(i + 1).unsqueeze(0)
-                ys_asr = torch.tensor(hyp['yseq_asr']).unsqueeze(0)
-
+                yseq, yseq_asr = hyp['yseq'], hyp['yseq_asr']
+                score = not ((yseq[-1] == self.eos and i > 2) or i < self.wait_k_asr)
+                score_asr = not ((yseq_asr[-1] == self.eos and i > 2) or i < self.wait_k_st)
+                if score or score_asr:
+                    key = (len(yseq), len(yseq_asr), score, score_asr)
+                    groups.setdefault(key, []).append(idx)
+            for (_, _, score, score_asr), idxs in groups.items():
+                # one host-to-device copy per group; the prefixes themselves stay on the host
+                ys = torch.from_numpy(np.stack([hyps[idx]['yseq'] for idx in idxs])).to(device)
+                ys_asr = torch.from_numpy(np.stack([hyps[idx]['yseq_asr'] for idx in idxs])).to(device)
+
+                cross_mask = cross_tril[:, :ys.size(1), :ys_asr.size(1)].expand(len(idxs), -1, -1)
+                cross_mask_asr = cross_tril_asr[:, :ys_asr.size(1), :ys.size(1)].expand(len(idxs), -1, -1)
                 # FIXME: jit does not match non-jit result
                 if use_jit:
-                    if traced_decoder is None:
-                        traced_decoder = torch.jit.trace(self.decoder.forward_one_step,
-                                                         (ys, ys_mask, enc_output))
-                    local_att_scores = traced_decoder(ys, ys_mask, enc_output)[0]
+                    # the trace is kept across utterances; it scores both heads without a cache
+                    step_inputs = (ys, ys_mask, ys_asr, ys_mask_asr, enc_output.expand(len(idxs), -1, -1),
+                                   cross_mask, cross_mask_asr)
+                    if self._traced_dual_step is None:
+                        self._traced_dual_step = torch.jit.trace(self._uncached_dual_step, step_inputs,
+                                                                 check_trace=False)
+                    with self._autocast(enc_output.device, autocast_dtype):
+                        att_scores, att_scores_asr = self._traced_dual_step(*step_inputs)
+                    cache, cache_asr = None, None
                 else:
-                    if hyp['yseq'][-1] != self.eos or hyp['yseq_asr'][-1] != self.eos or i < 2:
-                        cross_mask = create_cross_mask(ys, ys_asr, self.ignore_id, wait_k_cross=self.wait_k_asr)
-                        cross_mask_asr = create_cross_mask(ys_asr, ys, self.ignore_id, wait_k_cross=self.wait_k_st)
-                        local_att_scores, _, local_att_scores_asr, _ = self.dual_decoder.forward_one_step(ys, ys_mask, ys_asr, ys_mask_asr, enc_output,
-                                                                                                          cross_mask=cross_mask, cross_mask_asr=cross_mask_asr,
-                                                                                                          cross_self=self.cross_self, cross_src=self.cross_src,
-                                                                                                          cross_self_from=self.cross_self_from,
-                                                                                                          cross_src_from=self.cross_src_from)
-                    if (hyp['yseq'][-1] == self.eos and i > 2) or i < self.wait_k_asr:
-                        local_att_scores = None
-                    if (hyp['yseq_asr'][-1] == self.eos and i > 2) or i < self.wait_k_st:
-                        local_att_scores_asr = None
-
-                if local_att_scores is not None and local_att_scores_asr is not None:
-                    # local_att_scores_asr = decode_asr_weight * local_att_scores_asr
-                    xk, ixk = local_att_scores.topk(beam)
-                    yk, iyk = local_att_scores_asr.topk(beam)
-                    S = (torch.mm(torch.t(xk), torch.ones_like(xk))
-                                    + torch.mm(torch.t(torch.ones_like(yk)), yk))
-                    s2v = torch.LongTensor([[i, j] for i in ixk.squeeze(0) for j in iyk.squeeze(0)]) # (k^2) x 2
-
-                    # Do not force diversity
-                    if ratio_diverse_st <= 0 and ratio_diverse_asr <=0:
-                        local_best_scores, id2k = S.view(-1).topk(beam)
-                        I = s2v[id2k]
-                        local_best_ids_st = I[:,0]
-                        local_best_ids_asr = I[:,1]
-
-                    # Force diversity for ST only
-                    if ratio_diverse_st > 0 and ratio_diverse_asr <= 0:
-                        ct = int((1 - ratio_diverse_st) * beam)
-                        # logging.info(f'ct = {ct}')
-                        s2v = s2v.reshape(beam, beam, 2)
-                        Sc = S[:, :ct]
-                        local_best_scores, id2k = Sc.flatten().topk(beam)
-                        I = s2v[:, :ct]
-                        I = I.reshape(-1, 2)
-                        I = I[id2k]
-                        local_best_ids_st = I[:,0]
-                        local_best_ids_asr = I[:,1]
-
-                    # Force diversity for ASR only
-                    if ratio_diverse_asr > 0 and ratio_diverse_st <= 0:
-                        cr = int((1 - ratio_diverse_asr) * beam)
-                        # logging.info(f'cr = {cr}')
-                        s2v = s2v.reshape(beam, beam, 2)
-                        Sc = S[:cr, :]
-                        local_best_scores, id2k = Sc.view(-1).topk(beam)
-                        I = s2v[:cr, :]
-                        I = I.reshape(-1, 2)
-                        I = I[id2k]
-                        local_best_ids_st = I[:,0]
-                        local_best_ids_asr = I[:,1]
-
-                    # Force diversity for both ST and ASR
-                    if ratio_diverse_st > 0 and ratio_diverse_asr > 0:
-                        cr = int((1 - ratio_diverse_asr) * beam) 
-                        ct = int((1 - ratio_diverse_st) * beam)
-                        ct = max(ct, math.ceil(beam // cr))
-                        # logging.info(f'cr = {cr}')
-                        # logging.info(f'ct = {ct}')
-                                    
-                        s2v = s2v.reshape(beam, beam, 2)
-                        Sc = S[:cr, :ct]
-                        local_best_scores, id2k = Sc.flatten().topk(beam)
-                        I = s2v[:cr, :ct]
-                        I = I.reshape(-1, 2)
-                        I = I[id2k]
-                        local_best_ids_st = I[:,0]
-                        local_best_ids_asr = I[:,1]
-
-                elif local_att_scores is not None:
-                    local_best_scores, local_best_ids_st = torch.topk(local_att_scores, beam, dim=1)
-                    local_best_scores = local_best_scores.squeeze(0)
-                    local_best_ids_st = local_best_ids_st.squeeze(0)
-                elif local_att_scores_asr is not None:
-                    local_best_scores, local_best_ids_asr = torch.topk(local_att_scores_asr, beam, dim=1)
-                    local_best_ids_asr = local_best_ids_asr.squeeze(0)
-                    local_best_scores = local_best_scores.squeeze(0) 
+                    cache = self._batch_cache([hyps[idx].get('cache') for idx in idxs], ys) if use_cache else None
+                    cache_asr = self._batch_cache([hyps[idx].get('cache_asr') for idx in idxs], ys_asr) \
+                        if use_cache else None
+                    with self._autocast(enc_output.device, autocast_dtype):
+                        att_scores, cache, att_scores_asr, cache_asr = \
+                            self.dual_decoder.forward_one_step(ys, ys_mask, ys_asr, ys_mask_asr,
+                                                               enc_output.expand(len(idxs), -1, -1),
+                                                               cross_mask=cross_mask, cross_mask_asr=cross_mask_asr,
+                                                               cross_self=self.cross_self, cross_src=self.cross_src,
+                                                               cross_self_from=self.cross_self_from,
+                                                               cross_src_from=self.cross_src_from,
+                                                               cache=cache, cache_asr=cache_asr,
+                                                               score=score, score_asr=score_asr,
+                                                               memory_kv=memory_kv, dual_stream=dual_stream,
+                                                               normalize=False)
+                # select the beam best (st, asr) continuations of every hypothesis in the group
+                best_ids_st, best_ids_asr = None, None
+                # the decoder returns logits (reduced precision under autocast): they are cast to fp32,
+                # the beam is selected on them and only the selected ones are normalized,
+                # log_softmax(x)[k] = x[k] - logsumexp(x)
+                if att_scores is not None:
+                    att_scores = att_scores.float()
+                if att_scores_asr is not None:
+                    att_scores_asr = att_scores_asr.float()
+                if score and score_asr:
+                    # att_scores_asr = decode_asr_weight * att_scores_asr
+                    xk, ixk = att_scores.topk(beam)  # G x k
+                    xk = xk - att_scores.logsumexp(dim=-1, keepdim=True)
+                    yk, iyk = att_scores_asr.topk(beam)
+                    yk = yk - att_scores_asr.logsumexp(dim=-1, keepdim=True)
+                    # joint scores of the (st, asr) token pairs, S[g, m, n] = xk[g, m] + yk[g, n],
+                    # restricted to the first cr st and ct asr candidates to force diversity
+                    S = xk[:, :cr].unsqueeze(2) + yk[:, :ct].unsqueeze(1)  # G x cr x ct
+                    best_scores, id2k = S.reshape(len(idxs), -1).topk(beam)
+                    # map the flat grid positions back to the token ids of both heads
+                    best_ids_st = ixk.gather(1, id2k // ct)
+                    best_ids_asr = iyk.gather(1, id2k % ct)
+                elif score:
+                    best_scores, best_ids_st = att_scores.topk(beam)
+                    best_scores = best_scores - att_scores.logsumexp(dim=-1, keepdim=True)
                 else:
-                    raise NotImplementedError
-
-                for j in six.moves.range(beam):
-                    new_hyp = {}
-                    new_hyp['score'] = hyp['score'] + float(local_best_scores[j])
-                    new_hyp['yseq'] = [0] * (1 + len(hyp['yseq']))
-                    new_hyp['yseq'][:len(hyp['yseq'])] = hyp['yseq']
+                    best_scores, best_ids_asr = att_scores_asr.topk(beam)
+                    best_scores = best_scores - att_scores_asr.logsumexp(dim=-1, keepdim=True)
+
+                # read the selected scores and tokens back with one transfer each
+                best_scores = best_scores.tolist()
+                best_ids_st = best_ids_st.tolist() if best_ids_st is not None else None
+                best_ids_asr = best_ids_asr.tolist() if best_ids_asr is not None else None
+                for b, idx in enumerate(idxs):
+                    step_outputs[idx] = (
+                        best_scores[b],
+                        best_ids_st[b] if best_ids_st is not None else None,
+                        best_ids_asr[b] if best_ids_asr is not None else None,
+                        [c[b:b + 1] for c in cache] if cache is not None else None,
+                        [c[b:b + 1] for c in cache_asr] if cache_asr is not None else None)
 
-                    new_hyp['yseq_asr'] = [0] * (1 + len(hyp['yseq_asr']))
-                    new_hyp['yseq_asr'][:len(hyp['yseq_asr'])] = hyp['yseq_asr']
-
-                    if local_att_scores is not None:
-                        new_hyp['yseq'][len(hyp['yseq'])] = int(local_best_ids_st[j])
-                    else:
-                        if i >= self.wait_k_asr:
-                            new_hyp['yseq'][len(hyp['yseq'])] = self.eos
-                        else:
-                            new_hyp['yseq'] = hyp['yseq'] # v3
-                    
-                    if local_att_scores_asr is not None:
-                        new_hyp['yseq_asr'][len(hyp['yseq_asr'])] = int(local_best_ids_asr[j])
+            for idx, hyp in enumerate(hyps):
+                if step_outputs[idx] is None:
+                    raise NotImplementedError
+                scores_list, ids_st_list, ids_asr_list, new_cache, new_cache_asr = step_outputs[idx]
+
+                # a token to append, or None to keep the prefix while waiting (v3)
+                if ids_st_list is None:
+                    ids_st_list = [self.eos if i >= self.wait_k_asr else None] * beam
+                if ids_asr_list is None:
+                    ids_asr_list = [self.eos if i >= self.wait_k_st else None] * beam
+                hyp_score = hyp['score']
+                for local_score, tok_st, tok_asr in zip(scores_list, ids_st_list, ids_asr_list):
+                    # candidates only keep a pointer to their parent and the new tokens;
+                    # prefixes are copied for the beam survivors only
+                    entry = (hyp_score + local_score, -n_kept,
+                             (hyp, tok_st, tok_asr, new_cache, new_cache_asr))
+                    n_kept += 1
+                    if n_kept <= beam:
+                        heappush(hyps_best_kept, entry)
                     else:
-                        if i >= self.wait_k_st:
-                            new_hyp['yseq_asr'][len(hyp['yseq_asr'])] = self.eos
-                        else:
-                            new_hyp['yseq_asr'] = hyp['yseq_asr'] # v3
-
-                    hyps_best_kept.append(new_hyp)
-
-                    hyps_best_kept = sorted(
-                        hyps_best_kept, key=lambda x: x['score'], reverse=True)[:beam]
+                        heappushpop(hyps_best_kept, entry)
 
             # sort and get nbest
-            hyps = hyps_best_kept
+            hyps = []
+            for score, _, (parent, tok_st, tok_asr, new_cache, new_cache_asr) in sorted(
+                    hyps_best_kept, key=lambda e: (-e[0], -e[1])):
+                hyps.append({'score': score,
+                             'yseq': np.append(parent['yseq'], tok_st) if tok_st is not None else parent['yseq'],
+                             'yseq_asr': np.append(parent['yseq_asr'], tok_asr) if tok_asr is not None
+                             else parent['yseq_asr'],
+                             'cache': new_cache, 'cache_asr': new_cache_asr})
             logging.debug('number of pruned hypothes: ' + str(len(hyps)))
 
-            if char_list is not None:
-                logging.info('best hypo: ' + ''.join([char_list[int(x)] for x in hyps[0]['yseq']]))
-                logging.info('best hypo asr: ' + ''.join([char_list[int(x)] for x in hyps[0]['yseq_asr']]))
+            if log_hyps:
+                logging.debug('best hypo: ' + ''.join([char_list[x] for x in hyps[0]['yseq']]))
+                logging.debug('best hypo asr: ' + ''.join([char_list[x] for x in hyps[0]['yseq_asr']]))
 
             # add eos in the final loop to avoid that there are no ended hyps
             if i == maxlen - 1:
                 logging.info('adding <eos> in the last postion in the loop')
+                # prefixes may be shared with the parent hypothesis, extend copies
                 for hyp in hyps:
                     if hyp['yseq'][-1] != self.eos:
-                        hyp['yseq'].append(self.eos)
+                        hyp['yseq'] = np.append(hyp['yseq'], self.eos)
             if i == maxlen_asr - 1:
                 logging.info('adding <eos> in the last postion in the loop for asr')
                 for hyp in hyps:
                     if hyp['yseq_asr'][-1] != self.eos:
-                        hyp['yseq_asr'].append(self.eos)
+                        hyp['yseq_asr'] = np.append(hyp['yseq_asr'], self.eos)
 
             # add ended hypothes to a final list, and removed them from current hypothes
             # (this will be a problem, number of hyps < beam)
-            remained_hyps = []
-
-            for hyp in hyps:
-                if hyp['yseq'][-1] == self.eos and hyp['yseq_asr'][-1] == self.eos:
-                    # only store the sequence that has more than minlen outputs
-                    # also add penalty
-                    if len(hyp['yseq']) > minlen and len(hyp['yseq_asr']) > minlen_asr:
-                        hyp['score'] += (i + 1) * penalty
-                        # if rnnlm:  # Word LM needs to add final <eos> score
-                        #     hyp['score'] += trans_args.lm_weight * rnnlm.final(
-                        #         hyp['rnnlm_prev'])
-                        ended_hyps.append(hyp)
-                else:
-                    remained_hyps.append(hyp)
+            eos = self.eos
+            is_ended = [hyp['yseq'][-1] == eos and hyp['yseq_asr'][-1] == eos for hyp in hyps]
+            remained_hyps = [hyp for hyp, ended in zip(hyps, is_ended) if not ended]
+            # also add penalty
+            # if rnnlm:  # Word LM needs to add final <eos> score
+            #     hyp['score'] += trans_args.lm_weight * rnnlm.final(hyp['rnnlm_prev'])
+            new_ended_hyps = [hyp for hyp, ended in zip(hyps, is_ended) if ended]
+            for hyp in new_ended_hyps:
+                hyp['score'] += (i + 1) * penalty
+            # keep the too short ones per step in case the min length has to be relaxed
+            ended_hyps_per_step.append(new_ended_hyps)
+            # only store the sequence that has more than minlen outputs
+            ended_hyps.extend(hyp for hyp in new_ended_hyps
+                              if len(hyp['yseq']) > minlen and len(hyp['yseq_asr']) > minlen_asr)
 
             # end detection          
             if end_detect(ended_hyps, i) and trans_args.maxlenratio == 0.0:
                 logging.info('end detected at %d', i)
                 break
+            if simple_beam_stop and len(ended_hyps) >= beam:
+                logging.info(f'early stop: {len(ended_hyps)} ended hyps >= beam {beam}')
+                break
 
             hyps = remained_hyps
             if len(hyps) > 0:
@@ -718,10 +816,10 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
                 logging.info('no hypothesis. Finish decoding.')
                 break
 
-            if char_list is not None:
+            if log_hyps:
                 for hyp in hyps:
-                    logging.info('hypo: ' + ''.join([char_list[int(x)] for x in hyp['yseq'][1:]]))
-                    logging.info('hypo asr: ' + ''.join([char_list[int(x)] for x in hyp['yseq_asr'][1:]]))
+                    logging.debug('hypo: ' + ''.join([char_list[x] for x in hyp['yseq'][1:]]))
+                    logging.debug('hypo asr: ' + ''.join([char_list[x] for x in hyp['yseq_asr'][1:]]))
 
             logging.info('number of ended hypothes: ' + str(len(ended_hyps)))
 
@@ -729,19 +827,91 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
             ended_hyps, key=lambda x: x['score'], reverse=True)[:min(len(ended_hyps), trans_args.nbest)]
 
         # check number of hypotheis
-        if len(nbest_hyps) == 0:
-            logging.warning('there is no N-best results, perform recognition again with smaller minlenratio.')
+        # the beam does not depend on the min lengths, which only filter the ended hypotheses, and the
+        # search cannot have been stopped by end detection without any ended one: replaying the ended
+        # hypotheses of every step with smaller min lengths gives the result of decoding again
+        while len(nbest_hyps) == 0 and (trans_args.minlenratio > 0 or trans_args.minlenratio_asr > 0):
+            logging.warning('there is no N-best results, relax minlenratio on the ended hypotheses.')
             # should copy because Namespace will be overwritten globally
             trans_args = Namespace(**vars(trans_args))
             trans_args.minlenratio = max(0.0, trans_args.minlenratio - 0.1)
             trans_args.minlenratio_asr = max(0.0, trans_args.minlenratio_asr - 0.1)
-            return self.recognize_and_translate_sum(x, trans_args, char_list, rnnlm)
+            minlen = int(trans_args.minlenratio * h.size(0))
+            minlen_asr = int(trans_args.minlenratio_asr * h.size(0))
+            ended_hyps = []
+            for i, new_ended_hyps in enumerate(ended_hyps_per_step):
+                ended_hyps.extend(hyp for hyp in new_ended_hyps
+                                  if len(hyp['yseq']) > minlen and len(hyp['yseq_asr']) > minlen_asr)
+                if end_detect(ended_hyps, i) and trans_args.maxlenratio == 0.0:
+                    break
+                if simple_beam_stop and len(ended_hyps) >= beam:
+                    break
+            nbest_hyps = sorted(
+                ended_hyps, key=lambda x: x['score'], reverse=True)[:min(len(ended_hyps), trans_args.nbest)]
+
+        # without min lengths decoding again would give the same result
+        if len(nbest_hyps) == 0:
+            logging.warning('there is no N-best results, no hypothesis has ended.')
+            return []
 
         logging.info('total log probability: ' + str(nbest_hyps[0]['score']))
         logging.info('normalized log probability: ' + str(nbest_hyps[0]['score'] / len(nbest_hyps[0]['yseq'])))
 
+        # results are reported with python lists of token ids
+        for hyp in nbest_hyps:
+            hyp['yseq'] = hyp['yseq'].tolist()
+            hyp['yseq_asr'] = hyp['yseq_asr'].tolist()
+
         return nbest_hyps
 
+    def _uncached_dual_step(self, ys, ys_mask, ys_asr, ys_mask_asr, memory, cross_mask, cross_mask_asr):
+        """Score the next ST and ASR tokens without a cache (traced when decoding with use_jit).
+
+        :return: ST and ASR output logits (batch, odim)
+        :rtype: Tuple[torch.Tensor, torch.Tensor]
+        """
+        att_scores, _, att_scores_asr, _ = self.dual_decoder.forward_one_step(
+            ys, ys_mask, ys_asr, ys_mask_asr, memory,
+            cross_mask=cross_mask, cross_mask_asr=cross_mask_asr,
+            cross_self=self.cross_self, cross_src=self.cross_src,
+            cross_self_from=self.cross_self_from, cross_src_from=self.cross_src_from,
+            normalize=False)
+        return att_scores, att_scores_asr
+
+    def _batch_step_masks(self, max_steps, device):
+        """Return the self and cross attention masks of the decoding steps.
+
+        The masks are kept across utterances and only rebuilt for a longer utterance or another device.
+
+        :param int max_steps: number of decoding steps the masks must cover
+        :param torch.device device: device of the decoder
+        :return: self attention mask and ST-to-ASR and ASR-to-ST cross masks (1, max_steps, max_steps)
+        :rtype: Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+        """
+        if self._step_masks is None or self._step_masks[0].size(1) < max_steps \
+                or self._step_masks[0].device != device:
+            tril = subsequent_mask(max_steps, device=device).unsqueeze(0)
+            cross_tril = torch.tril(torch.ones(max_steps, max_steps, dtype=tril.dtype, device=device),
+                                    diagonal=self.wait_k_asr).unsqueeze(0)
+            cross_tril_asr = torch.tril(torch.ones(max_steps, max_steps, dtype=tril.dtype, device=device),
+                                        diagonal=self.wait_k_st).unsqueeze(0)
+            self._step_masks = (tril, cross_tril, cross_tril_asr)
+        return self._step_masks
+
+    @staticmethod
+    def _batch_cache(caches, ys):
+        """Stack the decoder caches of several hypotheses.
+
+        :param list caches: per hypothesis list of cached layer outputs (1, Lcache, adim)
+        :param torch.Tensor ys: current prefixes (B, L)
+        :return: per layer cached outputs (B, L - 1, adim),
+            None if any cache does not hold all but the last position of ys
+        :rtype: list
+        """
+        if any(c is None or c[0].size(1) != ys.size(1) - 1 for c in caches):
+            return None
+        return [torch.cat(layer_caches, dim=0) for layer_caches in zip(*caches)]
+
     def calculate_all_attentions(self, xs_pad, ilens, ys_pad, ys_pad_src):
         """E2E attention calculation.
 
@@ -754,10 +924,18 @@ class E2EDualDecoder(STInterface, torch.nn.Module):
             2) other case => attention weights (B, Lmax, Tmax).
         :rtype: float ndarray
         """
-        with torch.no_grad():
-            self.forward(xs_pad, ilens, ys_pad, ys_pad_src)
-        ret = dict()
-        for name, m in self.named_modules():
-            if isinstance(m, MultiHeadedAttention) and m.attn is not None:  # skip MHA for submodules
-                ret[name] = m.attn.cpu().numpy()
-        return ret
\ No newline at end of file
+        # fused attention kernels do not expose the attention weights
+        use_sdpa = {}
+        for m in self.modules():
+            if isinstance(m, MultiHeadedAttention):
+                use_sdpa[m] = m.use_sdpa
+                m.use_sdpa = False
+        try:
+            with torch.no_grad():
+                self.forward(xs_pad, ilens, ys_pad, ys_pad_src)
+        finally:
+            for m, flag in use_sdpa.items():
+                m.use_sdpa = flag
+        attns = {name: m.attn for name, m in self.named_modules()
+                 if isinstance(m, MultiHeadedAttention) and m.attn is not None}  # skip MHA for submodules
+        return {name: attn.cpu().numpy() for name, attn in attns.items()}
\ No newline at end of file
@@ -7,10 +7,12 @@
 """Multi-Head Attention layer definition."""
 
 import math
-import numpy
 import torch
 from torch import nn
 
+# fused attention kernels (FlashAttention / memory-efficient) are available from PyTorch 2.0
+is_sdpa_available = hasattr(nn.functional, 'scaled_dot_product_attention')
+
 
 class MultiHeadedAttention(nn.Module):
     """Multi-Head Attention layer.
@@ -18,10 +20,12 @@ class MultiHeadedAttention(nn.Module):
     :param int n_head: the number of head s
     :param int n_feat: the number of features
     :param float dropout_rate: dropout rate
+    :param bool use_sdpa: use torch.nn.functional.scaled_dot_product_attention if available,
+        attention weights are not stored in `self.attn` in that case
 
     """
 
-    def __init__(self, n_head, n_feat, dropout_rate):
+    def __init__(self, n_head, n_feat, dropout_rate, use_sdpa=False):
         """Construct an MultiHeadedAttention object."""
         super(MultiHeadedAttention, self).__init__()
         assert n_feat % n_head == 0
@@ -34,8 +38,9 @@ class MultiHeadedAttention(nn.Module):
         self.linear_out = nn.Linear(n_feat, n_feat)
         self.attn = None
         self.dropout = nn.Dropout(p=dropout_rate)
+        self.use_sdpa = use_sdpa
 
-    def forward(self, query, key, value, mask):
+    def forward(self, query, key, value, mask, kv=None):
         """Compute 'Scaled Dot Product Attention'.
 
         :param torch.Tensor query: (batch, time1, size)
@@ -43,21 +48,26 @@ class MultiHeadedAttention(nn.Module):
         :param torch.Tensor value: (batch, time2, size)
         :param torch.Tensor mask: (batch, time1, time2)
         :param torch.nn.Dropout dropout:
+        :param Tuple[torch.Tensor, torch.Tensor] kv: key and value already projected by
+            `project_kv` (1 or batch, head, time2, d_k), `key` and `value` are ignored if given
         :return torch.Tensor: attentined and transformed `value` (batch, time1, d_model)
              weighted by the query dot key attention (batch, head, time1, time2)
         """
         n_batch = query.size(0)
         q = self.linear_q(query).view(n_batch, -1, self.h, self.d_k)
-        k = self.linear_k(key).view(n_batch, -1, self.h, self.d_k)
-        v = self.linear_v(value).view(n_batch, -1, self.h, self.d_k)
         q = q.transpose(1, 2)  # (batch, head, time1, d_k)
-        k = k.transpose(1, 2)  # (batch, head, time2, d_k)
-        v = v.transpose(1, 2)  # (batch, head, time2, d_k)
+        if kv is None:
+            k, v = self.project_kv(key, value)
+        else:
+            k, v = (t.expand(n_batch, -1, -1, -1) for t in kv)
+
+        if self.use_sdpa and is_sdpa_available:
+            return self.linear_out(self._fused_attention(q, k, v, mask))
 
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)  # (batch, head, time1, time2)
         if mask is not None:
             mask = mask.unsqueeze(1).eq(0)  # (batch, 1, time1, time2)
-            min_value = float(numpy.finfo(torch.tensor(0, dtype=scores.dtype).numpy().dtype).min)
+            min_value = torch.finfo(scores.dtype).min
             scores = scores.masked_fill(mask, min_value)
             self.attn = torch.softmax(scores, dim=-1).masked_fill(mask, 0.0)  # (batch, head, time1, time2)
         else:
@@ -67,3 +77,39 @@ class MultiHeadedAttention(nn.Module):
         x = torch.matmul(p_attn, v)  # (batch, head, time1, d_k)
         x = x.transpose(1, 2).contiguous().view(n_batch, -1, self.h * self.d_k)  # (batch, time1, d_model)
         return self.linear_out(x)  # (batch, time1, d_model)
+
+    def project_kv(self, key, value):
+        """Project key and value into heads, e.g. once for a memory attended at every decoding step.
+
+        :param torch.Tensor key: (batch, time2, size)
+        :param torch.Tensor value: (batch, time2, size)
+        :return: projected key and value (batch, head, time2, d_k)
+        :rtype Tuple[torch.Tensor, torch.Tensor]
+        """
+        n_batch = key.size(0)
+        k = self.linear_k(key).view(n_batch, -1, self.h, self.d_k)
+        v = self.linear_v(value).view(n_batch, -1, self.h, self.d_k)
+        return k.transpose(1, 2), v.transpose(1, 2)
+
+    def _fused_attention(self, q, k, v, mask):
+        """Compute attention with a fused kernel without materializing the weights.
+
+        :param torch.Tensor q: (batch, head, time1, d_k)
+        :param torch.Tensor k: (batch, head, time2, d_k)
+        :param torch.Tensor v: (batch, head, time2, d_k)
+        :param torch.Tensor mask: (batch, time1, time2) or (batch, 1, time2)
+        :return torch.Tensor: attended values (batch, time1, d_model)
+        """
+        n_batch = q.size(0)
+        empty = None
+        if mask is not None:
+            mask = mask.unsqueeze(1).bool()  # (batch, 1, time1, time2)
+            # fully masked rows would give NaN, attend everywhere and zero them afterwards
+            empty = ~mask.any(dim=-1, keepdim=True)
+            mask = mask | empty
+        x = nn.functional.scaled_dot_product_attention(
+            q, k, v, attn_mask=mask, dropout_p=self.dropout.p if self.training else 0.0)
+        if empty is not None:
+            x = x.masked_fill(empty, 0.0)
+        self.attn = None
+        return x.transpose(1, 2).contiguous().view(n_batch, -1, self.h * self.d_k)  # (batch, time1, d_model)
@@ -35,6 +35,10 @@ class DualDecoder(ScorerInterface, torch.nn.Module):
     :param bool concat_after: whether to concat attention layer's input and output
         if True, additional linear will be applied. i.e. x -> x + linear(concat(x, att(x)))
         if False, no additional linear will be applied. i.e. x -> x + att(x)
+    :param bool use_sdpa: whether to compute attention with fused scaled_dot_product_attention kernels
+    :param bool fused_add_norm: whether to fuse residual adds with the following layer normalization
+    :param bool tie_embeddings: whether to share the output layer weights with the input embeddings
+    :param bool share_asr_embeddings: whether the ASR embeddings are shared with the ST embeddings
     """
 
     def __init__(self, odim,
@@ -57,7 +61,11 @@ class DualDecoder(ScorerInterface, torch.nn.Module):
                  cross_self=False,
                  cross_src=False,
                  cross_to_asr=True,
-                 cross_to_st=True):
+                 cross_to_st=True,
+                 use_sdpa=False,
+                 fused_add_norm=False,
+                 tie_embeddings=False,
+                 share_asr_embeddings=False):
         """Construct an Decoder object."""
         torch.nn.Module.__init__(self)
         if input_layer == "embed":
@@ -101,16 +109,16 @@ class DualDecoder(ScorerInterface, torch.nn.Module):
             num_blocks,
             lambda: DualDecoderLayer(
                 attention_dim, attention_dim,
-                MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate), 
-                MultiHeadedAttention(attention_heads, attention_dim, src_attention_dropout_rate), 
+                MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate, use_sdpa), 
+                MultiHeadedAttention(attention_heads, attention_dim, src_attention_dropout_rate, use_sdpa), 
                 PositionwiseFeedForward(attention_dim, linear_units, dropout_rate),
-                MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate), 
-                MultiHeadedAttention(attention_heads, attention_dim, src_attention_dropout_rate), 
+                MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate, use_sdpa), 
+                MultiHeadedAttention(attention_heads, attention_dim, src_attention_dropout_rate, use_sdpa), 
                 PositionwiseFeedForward(attention_dim, linear_units, dropout_rate),
-                cross_self_attn=MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate) if (cross_self and cross_to_st) else None, 
-                cross_self_attn_asr=MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate) if (cross_self and cross_to_asr) else None, 
-                cross_src_attn=MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate) if (cross_src and cross_to_st) else None, 
-                cross_src_attn_asr=MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate) if (cross_src and cross_to_asr) else None,
+                cross_self_attn=MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate, use_sdpa) if (cross_self and cross_to_st) else None, 
+                cross_self_attn_asr=MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate, use_sdpa) if (cross_self and cross_to_asr) else None, 
+                cross_src_attn=MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate, use_sdpa) if (cross_src and cross_to_st) else None, 
+                cross_src_attn_asr=MultiHeadedAttention(attention_heads, attention_dim, self_attention_dropout_rate, use_sdpa) if (cross_src and cross_to_asr) else None,
                 dropout_rate=dropout_rate,
                 normalize_before=normalize_before,
                 concat_after=concat_after,
@@ -118,7 +126,8 @@ class DualDecoder(ScorerInterface, torch.nn.Module):
                 cross_weight_learnable=cross_weight_learnable,
                 cross_weight=cross_weight,
                 cross_to_asr=cross_to_asr,
-                cross_to_st=cross_to_st
+                cross_to_st=cross_to_st,
+                fused_add_norm=fused_add_norm
             )
         )
         if self.normalize_before:
@@ -130,6 +139,13 @@ class DualDecoder(ScorerInterface, torch.nn.Module):
         else:
             self.output_layer = None
             self.output_layer_asr = None
+        if (tie_embeddings or share_asr_embeddings) and input_layer != "embed":
+            raise ValueError("embeddings can only be tied with input_layer == `embed`.")
+        if share_asr_embeddings:
+            self.embed_asr[0].weight = self.embed[0].weight
+        if tie_embeddings and use_output_layer:
+            self.output_layer.weight = self.embed[0].weight
+            self.output_layer_asr.weight = self.embed_asr[0].weight
 
     def forward(self, tgt, tgt_mask, tgt_asr, tgt_mask_asr, 
                 memory, memory_mask, 
@@ -172,7 +188,8 @@ class DualDecoder(ScorerInterface, torch.nn.Module):
                         cross_mask=None, cross_mask_asr=None, 
                         cross_self=False, cross_src=False,
                         cross_self_from="before-self", cross_src_from="before-src",
-                        cache=None, cache_asr=None):
+                        cache=None, cache_asr=None, score=True, score_asr=True, memory_kv=None,
+                        dual_stream=False, normalize=True):
         """Forward one step.
 
         :param torch.Tensor tgt: input token ids, int64 (batch, maxlen_out)
@@ -181,6 +198,12 @@ class DualDecoder(ScorerInterface, torch.nn.Module):
                                       dtype=torch.bool in PyTorch 1.2+ (include 1.2)
         :param torch.Tensor memory: encoded memory, float32  (batch, maxlen_in, feat)
         :param List[torch.Tensor] cache: cached output list of (batch, max_time_out-1, size)
+        :param bool score: compute the ST output scores (None is returned otherwise)
+        :param bool score_asr: compute the ASR output scores (None is returned otherwise)
+        :param List[tuple] memory_kv: projected memory keys and values per `self.dual_decoders`
+            from `precompute_memory_kv`
+        :param bool dual_stream: run the ASR branch of every layer on a side CUDA stream
+        :param bool normalize: return log probabilities, otherwise the output layer logits
         :return y, cache: NN output value and cache per `self.decoders`.
             `y.shape` is (batch, maxlen_out, token)
         :rtype: Tuple[torch.Tensor, List[torch.Tensor]]
@@ -191,29 +214,48 @@ class DualDecoder(ScorerInterface, torch.nn.Module):
             cache = self.init_state()
         if cache_asr is None:
             cache_asr = self.init_state()
+        if memory_kv is None:
+            memory_kv = self.init_state()
         new_cache = []
         new_cache_asr = []
-        for c, c_asr, dual_decoder in zip(cache, cache_asr, self.dual_decoders):
+        for c, c_asr, kv, dual_decoder in zip(cache, cache_asr, memory_kv, self.dual_decoders):
             x, tgt_mask, x_asr, tgt_mask_asr, memory, _, _, _, _, _, _, _ = dual_decoder(x, tgt_mask, x_asr, tgt_mask_asr,
                                                                                     memory, None, cross_mask, cross_mask_asr, 
                                                                                     cross_self, cross_src, 
                                                                                     cross_self_from, cross_src_from,
-                                                                                    cache=c, cache_asr=c_asr)
+                                                                                    cache=c, cache_asr=c_asr,
+                                                                                    memory_kv=kv, dual_stream=dual_stream)
             new_cache.append(x)
             new_cache_asr.append(x_asr)
 
-        if self.normalize_before:
-            y = self.after_norm(x[:, -1])
-            y_asr = self.after_norm_asr(x_asr[:, -1])
-        else:
-            y = x[:, -1]
-            y_asr = x_asr[:, -1]
-        if self.output_layer is not None:
-            y = torch.log_softmax(self.output_layer(y), dim=-1)
-            y_asr = torch.log_softmax(self.output_layer_asr(y_asr), dim=-1)
+        y, y_asr = None, None
+        if score:
+            y = self.after_norm(x[:, -1]) if self.normalize_before else x[:, -1]
+            if self.output_layer is not None:
+                y = self.output_layer(y)
+                if normalize:
+                    y = torch.log_softmax(y, dim=-1)
+        if score_asr:
+            y_asr = self.after_norm_asr(x_asr[:, -1]) if self.normalize_before else x_asr[:, -1]
+            if self.output_layer is not None:
+                y_asr = self.output_layer_asr(y_asr)
+                if normalize:
+                    y_asr = torch.log_softmax(y_asr, dim=-1)
 
         return y, new_cache, y_asr, new_cache_asr
 
+    def precompute_memory_kv(self, memory):
+        """Project the encoder memory for the source attentions of every layer once per utterance.
+
+        :param torch.Tensor memory: encoded memory, float32  (1, maxlen_in, feat)
+        :return: ST and ASR source attention keys and values per `self.dual_decoders`,
+            expanded over the batch in `forward_one_step`
+        :rtype: List[tuple]
+        """
+        return [(layer.src_attn.project_kv(memory, memory),
+                 layer.src_attn_asr.project_kv(memory, memory))
+                for layer in self.dual_decoders]
+
     # beam search API (see ScorerInterface)
     def init_state(self, x=None):
         """Get an initial state for decoding."""
@@ -9,9 +9,24 @@ import logging
 import torch
 from torch import nn
 
+from espnet.nets.pytorch_backend.transformer.layer_norm import add_layer_norm
 from espnet.nets.pytorch_backend.transformer.layer_norm import LayerNorm
 
 
+_asr_streams = {}
+
+
+def _asr_stream(device):
+    """Return the side CUDA stream the ASR branch of the dual decoder layers runs on.
+
+    :param torch.device device: device of the decoder
+    :rtype: torch.cuda.Stream
+    """
+    if device not in _asr_streams:
+        _asr_streams[device] = torch.cuda.Stream(device=device)
+    return _asr_streams[device]
+
+
 class DualDecoderLayer(nn.Module):
     """Single decoder layer module.
 
@@ -25,6 +40,8 @@ class DualDecoderLayer(nn.Module):
     :param bool concat_after: whether to concat attention layer's input and output
         if True, additional linear will be applied. i.e. x -> x + linear(concat(x, att(x)))
         if False, no additional linear will be applied. i.e. x -> x + att(x)
+    :param bool fused_add_norm: whether to fuse the residual adds with the following
+        layer normalization (normalize_before only, GPU with PyTorch 2.0+)
 
     """
 
@@ -40,7 +57,8 @@ class DualDecoderLayer(nn.Module):
                  cross_weight_learnable=False, 
                  cross_weight=0.0,
                  cross_to_asr=True,
-                 cross_to_st=True):
+                 cross_to_st=True,
+                 fused_add_norm=False):
         """Construct an DecoderLayer object."""
         super(DualDecoderLayer, self).__init__()
         self.size = size
@@ -97,6 +115,7 @@ class DualDecoderLayer(nn.Module):
 
         self.normalize_before = normalize_before
         self.concat_after = concat_after
+        self.fused_add_norm = fused_add_norm
         if self.concat_after:
             self.concat_linear1 = nn.Linear(size + size, size)
             self.concat_linear2 = nn.Linear(size + size, size)
@@ -108,7 +127,7 @@ class DualDecoderLayer(nn.Module):
                 cross_mask, cross_mask_asr,
                 cross_self=False, cross_src=False,
                 cross_self_from="before-self", cross_src_from="before-src", 
-                cache=None, cache_asr=None):
+                cache=None, cache_asr=None, memory_kv=None, dual_stream=False):
         """Compute decoded features.
 
         Args:
@@ -118,6 +137,10 @@ class DualDecoderLayer(nn.Module):
             memory_mask (torch.Tensor): mask for memory (batch, 1, max_time_in)
             cache (torch.Tensor): cached output (batch, max_time_out-1, size)
             cross (torch.Tensor): decoded previous target from another decoder (batch, max_time_out, size)
+            memory_kv (tuple): projected memory keys and values of the ST and ASR source attentions
+                from `project_kv`, used instead of projecting `memory` again
+            dual_stream (bool): run the ASR branch on a side CUDA stream concurrently with the ST branch
+                (inference with normalize_before only)
         """
         residual = tgt
         residual_asr = tgt_asr
@@ -138,6 +161,8 @@ class DualDecoderLayer(nn.Module):
             tgt_q_mask = None
             if tgt_mask is not None:
                 tgt_q_mask = tgt_mask[:, -1:, :]
+            if cross_mask is not None:
+                cross_mask = cross_mask[:, -1:, :]
 
         if cache_asr is None:
             tgt_q_asr = tgt_asr
@@ -151,28 +176,54 @@ class DualDecoderLayer(nn.Module):
             tgt_q_mask_asr = None
             if tgt_mask_asr is not None:
                 tgt_q_mask_asr = tgt_mask_asr[:, -1:, :]
+            if cross_mask_asr is not None:
+                cross_mask_asr = cross_mask_asr[:, -1:, :]
+
+        # the ST branch runs on the current stream and the ASR branch on a side stream,
+        # they only meet where the cross attentions read the other branch
+        stream = None
+        if dual_stream and self.normalize_before and tgt.is_cuda and not torch.is_grad_enabled():
+            stream = _asr_stream(tgt.device)
+            stream.wait_stream(torch.cuda.current_stream())
 
         # Self-attention
         if self.concat_after:
             tgt_concat = torch.cat((tgt_q, self.self_attn(tgt_q, tgt, tgt, tgt_q_mask)), dim=-1)
             x = self.concat_linear1(tgt_concat)
-            tgt_concat_asr = torch.cat((tgt_q_asr, self.self_attn_asr(tgt_q_asr, tgt_asr, tgt_asr, tgt_q_mask_asr)), dim=-1)
-            x_asr = self.concat_linear1_asr(tgt_concat_asr)
         else:
             x = self.dropout(self.self_attn(tgt_q, tgt, tgt, tgt_q_mask))
-            x_asr = self.dropout_asr(self.self_attn_asr(tgt_q_asr, tgt_asr, tgt_asr, tgt_q_mask_asr))
-        
+
         # Cross-self attention
-        if cross_self and cross_self_from == "before-self":
-            if self.cross_to_st:
-                z = self.dropout(self.cross_self_attn(tgt_q, tgt_asr, tgt_asr, cross_mask))
-                if self.cross_operator == 'sum':
-                    x = x + self.cross_weight * z
-                elif self.cross_operator == 'concat':
-                    x = self.cross_concat_linear1(torch.cat((x, z), dim=-1))
-                else:
-                    raise NotImplementedError
-            if self.cross_to_asr:
+        if cross_self and cross_self_from == "before-self" and self.cross_to_st:
+            z = self.dropout(self.cross_self_attn(tgt_q, tgt_asr, tgt_asr, cross_mask))
+            if self.cross_operator == 'sum':
+                x = x + self.cross_weight * z
+            elif self.cross_operator == 'concat':
+                x = self.cross_concat_linear1(torch.cat((x, z), dim=-1))
+            else:
+                raise NotImplementedError
+
+        if self.normalize_before:
+            # Source attention
+            residual, x = add_layer_norm(x, residual, self.norm2, self.fused_add_norm)
+        else:
+            x = x + residual
+            x = self.norm1(x)
+
+            # Source attention
+            residual = x
+        y = x
+
+        with torch.cuda.stream(stream):
+            # Self-attention
+            if self.concat_after:
+                tgt_concat_asr = torch.cat((tgt_q_asr, self.self_attn_asr(tgt_q_asr, tgt_asr, tgt_asr, tgt_q_mask_asr)), dim=-1)
+                x_asr = self.concat_linear1_asr(tgt_concat_asr)
+            else:
+                x_asr = self.dropout_asr(self.self_attn_asr(tgt_q_asr, tgt_asr, tgt_asr, tgt_q_mask_asr))
+
+            # Cross-self attention
+            if cross_self and cross_self_from == "before-self" and self.cross_to_asr:
                 z_asr = self.dropout_asr(self.cross_self_attn_asr(tgt_q_asr, tgt, tgt, cross_mask_asr))
                 if self.cross_operator == 'sum':
                     x_asr = x_asr + self.cross_weight_asr * z_asr
@@ -181,42 +232,64 @@ class DualDecoderLayer(nn.Module):
                 else:
                     raise NotImplementedError
 
-        x = x + residual
-        x_asr = x_asr + residual_asr
+            if self.normalize_before:
+                # Source attention
+                residual_asr, x_asr = add_layer_norm(x_asr, residual_asr, self.norm2_asr, self.fused_add_norm)
+            else:
+                x_asr = x_asr + residual_asr
+                x_asr = self.norm1_asr(x_asr)
 
-        if not self.normalize_before:
-            x = self.norm1(x)
-            x_asr = self.norm1_asr(x_asr)
+                # Source attention
+                residual_asr = x_asr
+            y_asr = x_asr
 
-        # Source attention
-        residual = x
-        residual_asr = x_asr
-        if self.normalize_before:
-            x = self.norm2(x)
-            x_asr = self.norm2_asr(x_asr)
-        y = x
-        y_asr = x_asr
+        if stream is not None:
+            # the cross-source attentions need both branches
+            torch.cuda.current_stream().wait_stream(stream)
+            stream.wait_stream(torch.cuda.current_stream())
 
+        kv, kv_asr = memory_kv if memory_kv is not None else (None, None)
         if self.concat_after:
-            x_concat = torch.cat((x, self.src_attn(x, memory, memory, memory_mask)), dim=-1)
+            x_concat = torch.cat((x, self.src_attn(x, memory, memory, memory_mask, kv=kv)), dim=-1)
             x = self.concat_linear2(x_concat)
-            x_concat_asr = torch.cat((x_asr, self.src_attn_asr(x_asr, memory, memory, memory_mask)), dim=-1)
-            x_asr = self.concat_linear2_asr(x_concat_asr)
         else:
-            x = self.dropout(self.src_attn(x, memory, memory, memory_mask))
-            x_asr = self.dropout_asr(self.src_attn_asr(x_asr, memory, memory, memory_mask))
-        
+            x = self.dropout(self.src_attn(x, memory, memory, memory_mask, kv=kv))
+
         # Cross-source attention
-        if cross_src and cross_src_from == "before-src":
-            if self.cross_to_st:
-                z = self.dropout(self.cross_src_attn(y, y_asr, y_asr, cross_mask))
-                if self.cross_operator == 'sum':
-                    x = x + self.cross_weight * z
-                elif self.cross_operator == 'concat':
-                    x = self.cross_concat_linear2(torch.cat((x, z), dim=-1))
-                else:
-                    raise NotImplementedError
-            if self.cross_to_asr:
+        if cross_src and cross_src_from == "before-src" and self.cross_to_st:
+            z = self.dropout(self.cross_src_attn(y, y_asr, y_asr, cross_mask))
+            if self.cross_operator == 'sum':
+                x = x + self.cross_weight * z
+            elif self.cross_operator == 'concat':
+                x = self.cross_concat_linear2(torch.cat((x, z), dim=-1))
+            else:
+                raise NotImplementedError
+
+        if self.normalize_before:
+            # Feed forward
+            residual, x = add_layer_norm(x, residual, self.norm3, self.fused_add_norm)
+        else:
+            x = x + residual
+            x = self.norm2(x)
+
+            # Feed forward
+            residual = x
+        x = residual + self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm3(x)
+
+        if cache is not None:
+            x = torch.cat([cache, x], dim=1)
+
+        with torch.cuda.stream(stream):
+            if self.concat_after:
+                x_concat_asr = torch.cat((x_asr, self.src_attn_asr(x_asr, memory, memory, memory_mask, kv=kv_asr)), dim=-1)
+                x_asr = self.concat_linear2_asr(x_concat_asr)
+            else:
+                x_asr = self.dropout_asr(self.src_attn_asr(x_asr, memory, memory, memory_mask, kv=kv_asr))
+
+            # Cross-source attention
+            if cross_src and cross_src_from == "before-src" and self.cross_to_asr:
                 z_asr = self.dropout_asr(self.cross_src_attn_asr(y_asr, y, y, cross_mask_asr))
                 if self.cross_operator == 'sum':
                     x_asr = x_asr + self.cross_weight_asr * z_asr
@@ -224,32 +297,27 @@ class DualDecoderLayer(nn.Module):
                     x_asr = self.cross_concat_linear2_asr(torch.cat((x_asr, z_asr), dim=-1))
                 else:
                     raise NotImplementedError
-        
-        x = x + residual
-        x_asr = x_asr + residual_asr
-        
-        if not self.normalize_before:
-            x = self.norm2(x)
-            x_asr = self.norm2_asr(x)
-        
-        # Feed forward
-        residual = x
-        residual_asr = x_asr
 
-        if self.normalize_before:
-            x = self.norm3(x)
-            x_asr = self.norm3_asr(x_asr)
-        x = residual + self.dropout(self.feed_forward(x))
-        x_asr = residual_asr + self.dropout_asr(self.feed_forward_asr(x_asr))
-        if not self.normalize_before:
-            x = self.norm3(x)
-            x_asr = self.norm3_asr(x_asr)
-        
-        if cache is not None:
-            x = torch.cat([cache, x], dim=1)
-        if cache_asr is not None:
-            x_asr = torch.cat([cache_asr, x_asr], dim=1)
+            if self.normalize_before:
+                # Feed forward
+                residual_asr, x_asr = add_layer_norm(x_asr, residual_asr, self.norm3_asr, self.fused_add_norm)
+            else:
+                # NOTE: the post-norm ASR branch has always normalized the ST features here
+                # (`residual` of the ST branch), kept as is for trained models
+                x_asr = self.norm2_asr(residual)
+
+                # Feed forward
+                residual_asr = x_asr
+            x_asr = residual_asr + self.dropout_asr(self.feed_forward_asr(x_asr))
+            if not self.normalize_before:
+                x_asr = self.norm3_asr(x_asr)
+
+            if cache_asr is not None:
+                x_asr = torch.cat([cache_asr, x_asr], dim=1)
+
+        if stream is not None:
+            torch.cuda.current_stream().wait_stream(stream)
 
         return x, tgt_mask, x_asr, tgt_mask_asr, \
                 memory, memory_mask, cross_mask, cross_mask_asr, \
-                cross_self, cross_src, cross_self_from, cross_src_from
\ No newline at end of file
+                cross_self, cross_src, cross_self_from, cross_src_from
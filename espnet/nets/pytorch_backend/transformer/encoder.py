@@ -115,18 +115,24 @@ class Encoder(torch.nn.Module):
         if self.normalize_before:
             self.after_norm = LayerNorm(attention_dim)
 
-    def forward(self, xs, masks):
+    def forward(self, xs, masks, xs_bias=None):
         """Encode input sequence.
 
         :param torch.Tensor xs: input tensor
         :param torch.Tensor masks: input mask
+        :param torch.Tensor xs_bias: optional (batch, 1, idim) bias added to every input frame
         :return: position embedded tensor and mask
         :rtype Tuple[torch.Tensor, torch.Tensor]:
         """
-        if isinstance(self.embed, (Conv2dSubsampling, VGG2L)):
-            xs, masks = self.embed(xs, masks)
+        if isinstance(self.embed, Conv2dSubsampling):
+            xs, masks = self.embed(xs, masks, xs_bias)
         else:
-            xs = self.embed(xs)
+            if xs_bias is not None:
+                xs = xs + xs_bias
+            if isinstance(self.embed, VGG2L):
+                xs, masks = self.embed(xs, masks)
+            else:
+                xs = self.embed(xs)
         xs, masks = self.encoders(xs, masks)
         if self.normalize_before:
             xs = self.after_norm(xs)
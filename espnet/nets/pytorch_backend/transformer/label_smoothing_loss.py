@@ -6,6 +6,8 @@
 
 """Label smoothing module."""
 
+import math
+
 import torch
 from torch import nn
 
@@ -18,6 +20,10 @@ class LabelSmoothingLoss(nn.Module):
     :param float smoothing: smoothing rate (0.0 means the conventional CE)
     :param bool normalize_length: normalize loss by sequence length if True
     :param torch.nn.Module criterion: loss function to be smoothed
+
+    After each forward, ``acc_stats`` holds a (2,) tensor with the number of correctly
+    predicted and of non-padded tokens, so that callers can compute the accuracy
+    without another pass over the logits.
     """
 
     def __init__(self, size, padding_idx, smoothing, normalize_length=False, criterion=nn.KLDivLoss(reduction="none")):
@@ -30,6 +36,7 @@ class LabelSmoothingLoss(nn.Module):
         self.size = size
         self.true_dist = None
         self.normalize_length = normalize_length
+        self.acc_stats = None
 
     def forward(self, x, target):
         """Compute loss between x and target.
@@ -43,6 +50,8 @@ class LabelSmoothingLoss(nn.Module):
         batch_size = x.size(0)
         x = x.view(-1, self.size)
         target = target.view(-1)
+        if self._use_closed_form():
+            return self._closed_form(x, target, batch_size)
         with torch.no_grad():
             true_dist = x.clone()
             true_dist.fill_(self.smoothing / (self.size - 1))
@@ -50,6 +59,48 @@ class LabelSmoothingLoss(nn.Module):
             total = len(target) - ignore.sum().item()
             target = target.masked_fill(ignore, 0)  # avoid -1 index
             true_dist.scatter_(1, target.unsqueeze(1), self.confidence)
+            correct = (x.argmax(dim=1) == target).masked_fill(ignore, 0).sum()
+            self.acc_stats = torch.stack([correct, len(target) - ignore.sum()])
         kl = self.criterion(torch.log_softmax(x, dim=1), true_dist)
         denom = total if self.normalize_length else batch_size
         return kl.masked_fill(ignore.unsqueeze(1), 0).sum() / denom
+
+    def _use_closed_form(self):
+        """Check whether the criterion is the plain KL divergence handled by _closed_form."""
+        return isinstance(self.criterion, nn.KLDivLoss) and self.criterion.reduction == "none" \
+            and not getattr(self.criterion, "log_target", False)
+
+    def _closed_form(self, x, target, batch_size):
+        """Compute the smoothed KL divergence without materializing the target distribution.
+
+        With off-target mass s = smoothing / (size - 1), the KL divergence of each row is
+        H - (confidence - s) * logp[target] - s * sum(logp), where H is the constant
+        negative entropy of the smoothed distribution. Both log-probability terms
+        are obtained from a single logsumexp over the logits.
+
+        :param torch.Tensor x: prediction (batch * seqlen, class)
+        :param torch.Tensor target: target signal masked with self.padding_id (batch * seqlen)
+        :param int batch_size: batch size used when the loss is not length normalized
+        :return: scalar float value
+        :rtype torch.Tensor
+        """
+        x = x.float()
+        ignore = target == self.padding_idx
+        target = target.masked_fill(ignore, 0)  # avoid -1 index
+        lse = torch.logsumexp(x, dim=1)
+        x_target = x.gather(1, target.unsqueeze(1)).squeeze(1)
+        logp_target = x_target - lse
+        with torch.no_grad():
+            # the target is the prediction when its logit is the row maximum
+            correct = (x_target >= x.max(dim=1)[0]).masked_fill(ignore, 0).sum()
+            self.acc_stats = torch.stack([correct, len(target) - ignore.sum()])
+        logp_sum = x.sum(dim=1) - self.size * lse
+        off = self.smoothing / (self.size - 1)
+        neg_entropy = self.confidence * math.log(self.confidence) if self.confidence > 0 else 0.0
+        if off > 0:
+            neg_entropy += (self.size - 1) * off * math.log(off)
+        kl = neg_entropy - (self.confidence - off) * logp_target - off * logp_sum
+        kl = kl.masked_fill(ignore, 0).sum()
+        if self.normalize_length:
+            return kl / self.acc_stats[1]
+        return kl / batch_size
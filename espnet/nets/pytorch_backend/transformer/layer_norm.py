@@ -31,3 +31,34 @@ class LayerNorm(torch.nn.LayerNorm):
         if self.dim == -1:
             return super(LayerNorm, self).forward(x)
         return super(LayerNorm, self).forward(x.transpose(1, -1)).transpose(1, -1)
+
+
+def _add_layer_norm(x, residual, weight, bias, eps):
+    """Return the residual sum and its layer normalization over the last dimension."""
+    y = x + residual
+    return y, torch.nn.functional.layer_norm(y, (y.size(-1),), weight, bias, eps)
+
+
+_compiled_add_layer_norm = None
+
+
+def add_layer_norm(x, residual, norm, fused=False):
+    """Add a residual and apply layer normalization to the sum.
+
+    With ``fused=True`` on GPU (PyTorch 2.0+), the add and the normalization are
+    compiled into a single kernel with torch.compile.
+
+    :param torch.Tensor x: input tensor
+    :param torch.Tensor residual: residual tensor added to x
+    :param LayerNorm norm: layer normalization module applied to the sum
+    :param bool fused: whether to use the compiled kernel when available
+    :return: residual sum and its normalized value
+    :rtype Tuple[torch.Tensor, torch.Tensor]
+    """
+    global _compiled_add_layer_norm
+    if fused and x.is_cuda and getattr(norm, "dim", -1) == -1 and hasattr(torch, "compile"):
+        if _compiled_add_layer_norm is None:
+            _compiled_add_layer_norm = torch.compile(_add_layer_norm, dynamic=True)
+        return _compiled_add_layer_norm(x, residual, norm.weight, norm.bias, norm.eps)
+    y = x + residual
+    return y, norm(y)
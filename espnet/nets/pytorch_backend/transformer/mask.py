@@ -51,8 +51,9 @@ def create_cross_mask(ys_in_pad, ys_cross_pad, ignore_id, wait_k_cross=0):
     :rtype: torch.Tensor
     """
     ys_cross_pad = ys_cross_pad != ignore_id
-    m = torch.tril(torch.ones(ys_in_pad.size(-1), ys_cross_pad.size(-1),
-                              device=ys_cross_pad.device, dtype=datatype),
-                   diagonal=wait_k_cross)
+    device = ys_cross_pad.device
+    # position i may attend to cross positions j <= i + wait_k_cross
+    m = (torch.arange(ys_cross_pad.size(-1), device=device).unsqueeze(0)
+         <= torch.arange(ys_in_pad.size(-1), device=device).unsqueeze(1) + wait_k_cross)
     m = m.unsqueeze(0)
     return ys_cross_pad.unsqueeze(-2) & m
\ No newline at end of file
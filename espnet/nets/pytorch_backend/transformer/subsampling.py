@@ -34,18 +34,36 @@ class Conv2dSubsampling(torch.nn.Module):
             PositionalEncoding(odim, dropout_rate)
         )
 
-    def forward(self, x, x_mask):
+    def forward(self, x, x_mask, x_bias=None):
         """Subsample x.
 
         :param torch.Tensor x: input tensor
         :param torch.Tensor x_mask: input mask
+        :param torch.Tensor x_bias: optional (b, 1, f) bias added to every input frame
         :return: subsampled x and mask
         :rtype Tuple[torch.Tensor, torch.Tensor]
         """
         x = x.unsqueeze(1)  # (b, c, t, f)
-        x = self.conv(x)
+        if x_bias is None:
+            x = self.conv(x)
+        else:
+            # the first conv is linear and unpadded, so a time-invariant input
+            # bias only shifts its output by a (b, odim, 1, f') term
+            x = self.conv[0](x) + self._bias_response(x_bias)
+            x = self.conv[1:](x)
         b, c, t, f = x.size()
         x = self.out(x.transpose(1, 2).contiguous().view(b, t, c * f))
         if x_mask is None:
             return x, None
         return x, x_mask[:, :, :-2:2][:, :, :-2:2]
+
+    def _bias_response(self, x_bias):
+        """Compute the bias-free response of the first conv to a constant frame bias.
+
+        :param torch.Tensor x_bias: bias tensor (b, 1, f)
+        :return: response broadcastable over time (b, odim, 1, f')
+        :rtype torch.Tensor
+        """
+        conv = self.conv[0]
+        x_bias = x_bias.unsqueeze(1).expand(-1, -1, conv.kernel_size[0], -1)
+        return torch.nn.functional.conv2d(x_bias, conv.weight, None, conv.stride)
@@ -164,3 +164,23 @@ def test_pytorch_trainable_transferable_and_decodable(enc_init, enc_mods, dec_in
     with torch.no_grad():
         in_data = np.random.randn(20, idim)
         model.recognize(in_data, args, args.char_list)
+
+
+def test_filter_modules_prefix_match():
+    transfer = importlib.import_module('espnet.asr.pytorch_backend.asr_init')
+    state_dict = dict.fromkeys(['dec.embed.weight', 'dec.decoder.0.weight', 'enc.enc.0.bias', 'enc.enc.1.bias'])
+
+    assert transfer.filter_modules(state_dict, ['enc.', 'dec.decoder.1', 'test']) == ['enc.']
+    assert transfer.filter_modules(state_dict, ['dec.embed.', 'enc.enc.1']) == ['dec.embed.', 'enc.enc.1']
+    assert transfer.filter_modules(state_dict, ['enc.enc.1.bias.']) == []
+
+
+def test_filter_modules_dual_decoders_prefix_match():
+    transfer = importlib.import_module('espnet.asr.pytorch_backend.asr_init')
+    state_dict = dict.fromkeys(['decoder.decoders.0.self_attn.linear_q.weight',
+                                'decoder_asr.decoders.0.self_attn.linear_q.weight'])
+
+    assert transfer.filter_modules_dual_decoders(state_dict, []) == []
+    assert transfer.filter_modules_dual_decoders(
+        state_dict, ['dual_decoder.dual_decoders.0.self_attn.', 'dual_decoder.dual_decoders.0.self_attn_asr.']
+    ) == ['decoder.decoders.0.self_attn.', 'decoder_asr.decoders.0.self_attn.']
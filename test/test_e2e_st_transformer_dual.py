@@ -0,0 +1,132 @@
+# coding: utf-8
+
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import argparse
+import pytest
+import torch
+
+from espnet.nets.pytorch_backend.e2e_st_transformer_dual import E2EDualDecoder
+
+
+def make_arg(**kwargs):
+    defaults = dict(
+        adim=16,
+        aheads=2,
+        dropout_rate=0.0,
+        transformer_attn_dropout_rate=None,
+        elayers=2,
+        eunits=16,
+        dlayers=2,
+        dunits=16,
+        sym_space="<space>",
+        sym_blank="<blank>",
+        transformer_init="pytorch",
+        transformer_input_layer="conv2d",
+        transformer_length_normalized_loss=True,
+        report_bleu=False,
+        report_cer=False,
+        report_wer=False,
+        mtlalpha=0.0,
+        lsm_weight=0.001,
+        char_list=['<blank>', 'a', 'e', 'i', 'o', 'u', 'k', 's', 't', '<eos>'],
+        ctc_type="builtin",
+        asr_weight=0.3,
+        mt_weight=0.0,
+    )
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+def make_trans_arg(**kwargs):
+    defaults = dict(
+        beam_size=3,
+        penalty=0.0,
+        maxlenratio=1.0,
+        maxlenratio_asr=1.0,
+        minlenratio=0.0,
+        minlenratio_asr=0.0,
+        nbest=3,
+        tgt_lang=False,
+    )
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+def prepare(args):
+    idim = 20
+    odim = len(args.char_list)
+    torch.manual_seed(0)
+    model = E2EDualDecoder(idim, odim, args)
+    model.eval()
+    x = torch.randn(40, idim).numpy()
+    return model, x
+
+
+def step_by_step(forward_one_step):
+    """Wrap DualDecoder.forward_one_step to score every hypothesis on its own, without a cache."""
+    def step(tgt, tgt_mask, tgt_asr, tgt_mask_asr, memory, cross_mask=None, cross_mask_asr=None,
+             cache=None, cache_asr=None, memory_kv=None, **kwargs):
+        outs = [forward_one_step(tgt[b:b + 1], tgt_mask, tgt_asr[b:b + 1], tgt_mask_asr, memory[b:b + 1],
+                                 cross_mask=cross_mask[b:b + 1], cross_mask_asr=cross_mask_asr[b:b + 1],
+                                 **kwargs)
+                for b in range(tgt.size(0))]
+        y = torch.cat([o[0] for o in outs]) if outs[0][0] is not None else None
+        y_asr = torch.cat([o[2] for o in outs]) if outs[0][2] is not None else None
+        return y, None, y_asr, None
+    return step
+
+
+def assert_same_nbest(nbest, nbest_ref):
+    assert len(nbest) == len(nbest_ref)
+    for hyp, hyp_ref in zip(nbest, nbest_ref):
+        assert hyp['yseq'] == hyp_ref['yseq']
+        assert hyp['yseq_asr'] == hyp_ref['yseq_asr']
+        assert hyp['score'] == pytest.approx(hyp_ref['score'], abs=1e-4)
+
+
+@pytest.mark.parametrize(
+    "model_dict", [
+        {},
+        {'cross_self': True, 'cross_to_asr': True, 'cross_to_st': True, 'cross_operator': 'sum',
+         'cross_weight': 0.3},
+        {'cross_src': True, 'cross_to_asr': True, 'cross_to_st': True, 'cross_operator': 'concat'},
+        {'cross_self': True, 'cross_src': True, 'cross_to_asr': True, 'cross_to_st': True,
+         'cross_operator': 'sum', 'cross_weight': 0.3},
+        {'wait_k_asr': 2},
+        {'wait_k_st': 2},
+        {'wait_k_asr': 2, 'cross_self': True, 'cross_to_asr': True, 'cross_to_st': True,
+         'cross_operator': 'sum', 'cross_weight': 0.3},
+        {'wait_k_st': 2, 'cross_self': True, 'cross_to_asr': True, 'cross_to_st': True,
+         'cross_operator': 'concat'},
+        {'wait_k_asr': 2, 'cross_src': True, 'cross_to_asr': True, 'cross_to_st': True,
+         'cross_operator': 'concat'},
+    ]
+)
+def test_dual_decoder_batch_decoding(model_dict, monkeypatch):
+    args = make_arg(**model_dict)
+    model, x = prepare(args)
+    trans_args = make_trans_arg()
+
+    with torch.no_grad():
+        nbest = model.recognize_and_translate_sum(x, trans_args, args.char_list)
+        monkeypatch.setattr(model.dual_decoder, "forward_one_step",
+                            step_by_step(model.dual_decoder.forward_one_step))
+        nbest_ref = model.recognize_and_translate_sum(x, trans_args, args.char_list)
+    assert len(nbest) > 0
+    assert_same_nbest(nbest, nbest_ref)
+
+
+def test_dual_decoder_no_ended_hypothesis():
+    args = make_arg()
+    model, x = prepare(args)
+    # the ST prefixes forced to end at the first step are extended again at the next ones
+    # (ends only become final after the third step), so with <eos> never selected by either
+    # decoder the ST prefixes have not ended when the ASR prefixes are forced to end
+    trans_args = make_trans_arg(maxlenratio=0.01)
+
+    with torch.no_grad():
+        model.dual_decoder.output_layer.bias[model.eos] = -1e4
+        model.dual_decoder.output_layer_asr.bias[model.eos] = -1e4
+        nbest = model.recognize_and_translate_sum(x, trans_args, args.char_list)
+    assert nbest == []
@@ -133,3 +133,31 @@ def test_train_acc():
     th_acc = th_accuracy(th_pred, th_target, th_ignore)
 
     numpy.testing.assert_allclose(ch_acc.data, th_acc)
+
+
+@pytest.mark.parametrize('smoothing', [0.0, 0.1])
+@pytest.mark.parametrize('normalize_length', [True, False])
+def test_label_smoothing_loss_closed_form(smoothing, normalize_length):
+    from espnet.nets.pytorch_backend.transformer.label_smoothing_loss import LabelSmoothingLoss
+
+    n_out = 7
+    x = torch.randn(3, 5, n_out, requires_grad=True)
+    target = torch.randint(0, n_out, (3, 5))
+    target[0, 3:] = -1
+    target[2, 1:] = -1
+
+    fused = LabelSmoothingLoss(n_out, -1, smoothing, normalize_length)
+    reference = LabelSmoothingLoss(n_out, -1, smoothing, normalize_length,
+                                   criterion=lambda x, t: torch.nn.functional.kl_div(x, t, reduction="none"))
+    assert fused._use_closed_form()
+    loss = fused(x, target)
+    loss_ref = reference(x, target)
+    numpy.testing.assert_allclose(loss.item(), loss_ref.item(), rtol=1e-5)
+    acc = th_accuracy(x.detach().view(-1, n_out), target, -1)
+    for criterion in (fused, reference):
+        correct, total = criterion.acc_stats.tolist()
+        numpy.testing.assert_allclose(correct / total, acc)
+
+    grad, = torch.autograd.grad(loss, x)
+    grad_ref, = torch.autograd.grad(loss_ref, x)
+    numpy.testing.assert_allclose(grad.numpy(), grad_ref.numpy(), rtol=1e-4, atol=1e-6)
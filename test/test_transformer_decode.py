@@ -2,6 +2,7 @@ import numpy
 import pytest
 import torch
 
+from espnet.nets.pytorch_backend.transformer.attention import MultiHeadedAttention
 from espnet.nets.pytorch_backend.transformer.decoder import Decoder
 from espnet.nets.pytorch_backend.transformer.encoder import Encoder
 from espnet.nets.pytorch_backend.transformer.mask import subsequent_mask
@@ -72,6 +73,23 @@ def test_encoder_cache(normalize_before):
         numpy.testing.assert_allclose(y.numpy(), y_fast.numpy(), rtol=1e-5)
 
 
+@pytest.mark.skipif(not hasattr(torch, "autocast"), reason="torch.autocast is not available")
+def test_attention_bf16_autocast_padded_mask():
+    adim = 8
+    attn = MultiHeadedAttention(2, adim, 0.0, use_sdpa=False)
+    attn.eval()
+    x = torch.randn(2, 5, adim)
+    # the second sequence is padded after 3 frames
+    mask = torch.ones(2, 1, 5, dtype=torch.bool)
+    mask[1, :, 3:] = False
+    with torch.no_grad():
+        y = attn(x, x, x, mask)
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            y_bf16 = attn(x, x, x, mask)
+    assert torch.all(attn.attn[1, :, :, 3:] == 0)
+    numpy.testing.assert_allclose(y.numpy(), y_bf16.float().numpy(), atol=5e-2, rtol=5e-2)
+
+
 if __name__ == "__main__":
     # benchmark with synth dataset
     from time import time